@@ -25,5 +25,5 @@ setup(name="tidetools",
     install_requires=["setuptools"],
     packages=['tidetools'],
     package_dir={'tidetools':'tidetools'},
-    #entry_points={'console_scripts': ['tool = tidetools.file:main',]},
+    entry_points={'console_scripts': ['tidePipeline = tidetools.tidePipeline:main',]},
 )
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Convert tide files to and from the binary tidebin cache format.
+
+A tidebin file holds a small header (station, sampling interval,
+minimum and maximum water level) followed by contiguous columns of
+epoch microseconds and water levels. The tools read it through a
+memory map, so a run that only needs a time slice only touches the
+pages holding that slice. See tideLib for the layout.
+"""
+
+import sys
+from optparse import OptionParser
+
+import numpy as np
+
+from __init__ import __version__
+from tideLib import *
+
+
+def CommandLine():
+    '''
+    Process the command line options and arguments
+    '''
+
+    global options,args
+
+    p = OptionParser(usage="%prog [options] tide files",
+                     version="%prog "+__version__)
+    p.add_option("-i", "--inputFiles",
+                 type="string",
+                 dest="inputFiles",
+                 action="append",
+                 default=[],
+                 help="the files to read",
+                 metavar="FILE")
+    p.add_option('-I','--InputFormat'
+                      ,dest='inputFormat'
+                      ,type='choice'
+                      ,default='caris'
+                      ,choices=inputTypes+[autoFormat]
+                      ,help= 'Input time format. One of ' + \
+                          ', '.join(inputTypes+[autoFormat])+ \
+                          ' [default: %default] ')
+    p.add_option("-o", "--outputFile",
+                 default = None,
+                 type="string", dest="outputFile",
+                 help="the file to write to (overwrites)",
+                 metavar="FILE")
+    p.add_option('-O','--OutputFormat'
+                      ,dest='outputFormat'
+                      ,type='choice'
+                      ,default='tidebin'
+                      ,choices=inputTypes
+                      ,help= 'Output time format. One of ' + \
+                          ', '.join(inputTypes)+ ' [default: %default] ')
+    p.add_option("-s", "--station",
+                 default = '',
+                 type="string", dest="station",
+                 help="the station ID to store in a tidebin header")
+    p.add_option("--float32", action="store_true", default=False,
+                 dest="float32",
+                 help="store tidebin water levels as 32 bit floats")
+    p.add_option("-v", "--verbose", action="store_true", default=False,
+                 dest="verbose",
+                 help="")
+    p.add_option("--FieldSeparator", default = '\t',
+                 type="string", dest="fieldSep",
+                 help="the character(s) used to separate fields in the files; [default '\\t']")
+    p.add_option("--RecordSeparator", default = '\n',
+                 type="string", dest="recSep",
+                 help="the character(s) used to separate records in the files; [default '\\n']")
+
+    (options,args) = p.parse_args()
+
+    if options.outputFormat == 'tidebin' and options.outputFile == None:
+        p.error('tidebin output needs an output file (-o)')
+
+    return(p)
+
+
+def main():
+
+    global options, args
+
+    p = CommandLine()
+
+    filelist = args + options.inputFiles
+    if len(filelist) == 0:
+        p.error('no input files')
+
+    timesList = []
+    levelsList = []
+    station = options.station
+    for filename in filelist:
+        inputFormat = options.inputFormat
+        if inputFormat == autoFormat:
+            inF = open(filename,"r")
+            (inputFormat,inF) = sniffTideFormat(inF,
+                                                options.fieldSep,
+                                                options.recSep)
+            inF.close()
+            if inputFormat == None:
+                p.error('could not tell the format of %s' % filename)
+        (times,levels,others) = readTideFileToArrays(filename,
+                                                     inputFormat,
+                                                     options.fieldSep,
+                                                     options.recSep)
+        if inputFormat == 'tidebin' and station == '':
+            station = readTideBinHeader(filename)['station']
+        timesList.append(times)
+        levelsList.append(levels)
+    times = np.concatenate(timesList)
+    levels = np.concatenate(levelsList)
+
+    if options.outputFormat == 'tidebin':
+        valueType = 'f8'
+        if options.float32:
+            valueType = 'f4'
+        writeTideBin(options.outputFile,times,levels,
+                     station=station,
+                     valueType=valueType)
+    else:
+        if options.outputFile != None:
+            outF = open(options.outputFile,"w")
+        else:
+            outF = sys.stdout
+        for start in xrange(0,len(times),defBlockSize):
+            tideOutputBlock(outF,
+                            timeFormat=options.outputFormat,
+                            times=times[start:start+defBlockSize],
+                            waterlevels=levels[start:start+defBlockSize],
+                            fieldSep=options.fieldSep,
+                            recSep=options.recSep)
+        outF.close()
+
+    if options.verbose:
+        sys.stderr.write("%d records\n" % len(times))
+
+
+if __name__ == '__main__':
+    main()
@@ -68,6 +68,15 @@ import string
 import os
 import re
 import sys
+import collections
+import calendar
+import cStringIO
+import glob
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
 import numpy as np
 
 from __init__ import __version__
@@ -79,6 +88,17 @@ A = -1.008E-01
 B = 5.125E-03
 C = 7.402E-08
 
+# per station (A, B, C, datumOffset), read from a --calibration file;
+# other stations use the coefficients above and --datum-offset
+calibrations = {}
+
+# the per station outputs of --demux
+outputPool = None
+
+# the -B and --quarantine files
+blf = None
+qf = None
+
 # input formats
 snttRE = re.compile(r'^\s*(\d+)\s+(\d+)\s+(\d+),(\w+),(\d+\.\d+)')
 dttnRE = re.compile(r'^\s*(\d+\/\d+\/\d+\s+\d+:\d+)\s+(\d+)\s+(-?\d+\.\d+)')
@@ -86,6 +106,17 @@ tvwlRE = re.compile(r'(\d+:\d+)\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)\s+(-?\d+\.\d+)')
 cdlRE = re.compile(r'^\s*(\d+\/\d+\/\d+),(\d+:\d+:\d+),\S*,(\d+\.\d+)')
 #Time/Date :   8 July-2009 16:53:00
 dateStrRE = re.compile(r'Time/Date\s+\:\s+(\d+)\s+(\w+-\d+)')
+# the start of a day header line that is not a comment, in a whole file
+dayHeaderRE = re.compile(r'^(?![^\S\n]*\#)[^\n]*Time/Date[^\S\n]+\:' +
+                         r'[^\S\n]+\d+[^\S\n]+\w+-\d+',re.M)
+
+# why a line could not be converted, as counted and in --quarantine
+noMatch = 'nomatch' # not a line of the input format
+badNumber = 'badnumber' # a field is not a number
+badTime = 'badtime' # a date or time that does not exist
+noDate = 'nodate' # a TVWL time before any Time/Date line
+
+maxTimestamp = 253402300800.0 # 10000-01-01, past the last datetime
 
 
 def snttParser(line,D=None):
@@ -98,22 +129,116 @@ def snttParser(line,D=None):
 
     global options
 
-    try:
-        result = snttRE.search(line)
-        # (stationId,N,rawTemp,station,timestamp)
-        fields = result.groups()
-        N = float(fields[1])
-        rawTemp = float(fields[2])
-        timestamp = float(fields[4])
-        DT =  datetime.datetime.utcfromtimestamp(timestamp)
+    result = snttRE.search(line)
+    if result == None:
+        return(None,None,noMatch)
+    # (stationId,N,rawTemp,station,timestamp)
+    fields = result.groups()
+    N = float(fields[1])
+    rawTemp = float(fields[2])
+    timestamp = float(fields[4])
+    if timestamp >= maxTimestamp:
+        return(None,None,badTime)
+    DT =  datetime.datetime.utcfromtimestamp(timestamp)
+    (a,b,c,datumOffset) = stationCoefficients(fields[3])
+
+    # water Level(m)=((A+BN+CN^2+DN^3)/d*g)) with D = 0.0
+    WL = ( a + b*N + c*(N**2) ) - datumOffset
+
+    return(DT,WL,None)
+
+# every line of an SNTT buffer at once: a comment, a record or bad
+snttBulkRE = re.compile(r'^(?:([^\S\n]*\#.*)|'
+                        r'[^\S\n]*\d+[^\S\n]+(\d+)[^\S\n]+\d+,(\w+),(\d+\.\d+).*|'
+                        r'(.*))$',re.M)
+
+def snttArrays(text):
+    '''
+    bulk version of snttParser for a buffer of whole SNTT lines.
+    Returns (times, waterLevels, good, badLines, stations) for the
+    lines that are not comments: datetime64 times, water levels (with
+    the datum offset applied), a mask of the lines that parsed and the
+    station names; entries where good is False are NaT, NaN and ''.
+    badLines has (index, reason, line) for the lines that did not
+    parse: the index of the line in text and the line as it was read.
+    '''
+
+    global options
 
-        # water Level(m)=((A+BN+CN^2+DN^3)/d*g)) with D = 0.0
-        WL = ( A + B*N + C*(N**2) ) - options.datumOffset
+    matches = snttBulkRE.findall(text)
+    if text.endswith('\n'):
+        matches = matches[:-1] # the empty match after the last newline
+    if len(matches) == 0:
+        return (np.empty(0,dtype='datetime64[us]'),np.empty(0),
+                np.empty(0,dtype=bool),[],np.empty(0,dtype=str))
+
+    (comments,Ns,stations,timestamps,others) = zip(*matches) # as in snttRE
+    data = np.array(comments) == ''
+    timestamps = np.array(timestamps)[data]
+    Ns = np.array(Ns)[data]
+    stations = np.array(stations)[data]
+
+    matched = timestamps != ''
+    N = np.where(matched,Ns,'0').astype(np.float64)
+    epoch = np.where(matched,timestamps,'0').astype(np.float64)
+    good = matched & (epoch < maxTimestamp)
+
+    badLines = []
+    if not good.all():
+        # the bad lines as they were read, with their newlines
+        lines = text.split('\n')
+        indexes = np.flatnonzero(data)[~good]
+        reasons = np.where(matched[~good],badTime,noMatch)
+        badLines = [(index,reason,lines[index] + '\n') for (index,reason)
+                    in zip(indexes.tolist(),reasons.tolist())]
+        if indexes[-1] == len(matches) - 1 and not text.endswith('\n'):
+            (index,reason,line) = badLines[-1]
+            badLines[-1] = (index,reason,line[:-1])
+
+    if len(calibrations) == 0:
+        (a,b,c,datumOffset) = (A,B,C,options.datumOffset)
+    else:
+        (names,station) = np.unique(stations,return_inverse=True)
+        coefficients = np.array([stationCoefficients(name)
+                                 for name in names.tolist()])[station]
+        (a,b,c,datumOffset) = coefficients.T
+
+    # water Level(m)=((A+BN+CN^2+DN^3)/d*g)) with D = 0.0
+    WL = ( a + b*N + c*(N**2) ) - datumOffset
+    WL[~good] = np.nan
+    times = np.round(epoch * 1e6).astype(np.int64).view('datetime64[us]')
+    times[~good] = np.datetime64('NaT')
+
+    return (times,WL,good,badLines,stations)
+
+def stationCoefficients(station):
+    '''
+    returns (A, B, C, datumOffset) for the station
+    '''
+    global options
+    if station in calibrations:
+        return calibrations[station]
+    return (A,B,C,options.datumOffset)
 
-    except:
-        return(None,None)
+def readCalibrations(filename):
+    '''
+    reads a calibration file into calibrations. Each line is
+      station A B C [datumOffset]
+    for example
+      rmemma -1.008E-01 5.125E-03 7.402E-08 0.35
+    Without a datumOffset --datum-offset is used.
+    '''
+
+    global options
 
-    return(DT,WL)
+    for line in file(filename):
+        if tideLib.skipRE.match(line):
+            continue
+        fields = line.split()
+        if len(fields) not in (4,5):
+            raise ValueError('bad calibration line: ' + line.strip())
+        values = [float(f) for f in fields[1:]] + [options.datumOffset]
+        calibrations[fields[0]] = tuple(values[:4])
 
 def dttnParser(line,D=None):
     '''
@@ -125,17 +250,19 @@ def dttnParser(line,D=None):
 
     global options
 
-    try:
-        result = dttnRE.search(line)
-        # (timeStr,rawTemp,N)
-        fields = result.groups()
-        rawTemp = float(fields[1])
-        WL = float(fields[2])
-        DT = datetime.datetime.strptime(fields[0],'%Y/%m/%d %H:%M')
-    except:
-        return(None,None)
+    result = dttnRE.search(line)
+    if result == None:
+        return(None,None,noMatch)
+    # (timeStr,rawTemp,N)
+    fields = result.groups()
+    rawTemp = float(fields[1])
+    WL = float(fields[2])
+    (dateStr,timeStr) = fields[0].split()
+    DT = makeDateTime(*(dateStr.split('/') + timeStr.split(':')))
+    if DT == None:
+        return(None,None,badTime)
 
-    return(DT,WL)
+    return(DT,WL,None)
 
 def cdlParser(line,D=None):
     '''
@@ -146,16 +273,17 @@ def cdlParser(line,D=None):
     '''
     global options
 
-    try:
-        result = cdlRE.search(line)
-        fields = result.groups()
-        DTstr = '%s %s' % (fields[0],fields[1])
-        WL = float(fields[2])
-        DT = datetime.datetime.strptime(DTstr,'%m/%d/%Y %H:%M:%S')
-    except:
-        return(None,None)
+    result = cdlRE.search(line)
+    if result == None:
+        return(None,None,noMatch)
+    fields = result.groups()
+    WL = float(fields[2])
+    (month,day,year) = fields[0].split('/')
+    DT = makeDateTime(year,month,day,*fields[1].split(':'))
+    if DT == None:
+        return(None,None,badTime)
 
-    return(DT,WL)
+    return(DT,WL,None)
 
 def tvwlParser(line,D=None):
     '''
@@ -169,19 +297,38 @@ def tvwlParser(line,D=None):
     '''
     global options
 
-    try:
-        result = tvwlRE.search(line)
-        # (timeStr,rawTemp,N)
-        fields = result.groups()
-        rawTemp = float(fields[3])
-        WL = float(fields[2])
-        (H,M)= string.split(fields[0],':')
-        T = datetime.timedelta(hours = int(H), minutes = int(M))
-        DT = D + T
-    except:
-        return(None,None)
-
-    return(DT,WL)
+    result = tvwlRE.search(line)
+    if result == None:
+        return(None,None,noMatch)
+    if not isinstance(D,datetime.datetime):
+        return(None,None,noDate)
+    # (timeStr,rawTemp,N)
+    fields = result.groups()
+    rawTemp = float(fields[3])
+    WL = float(fields[2])
+    (H,M)= string.split(fields[0],':')
+    T = datetime.timedelta(hours = int(H), minutes = int(M))
+    DT = D + T
+
+    return(DT,WL,None)
+
+def makeDateTime(year,month,day,hour,minute,second='0'):
+    '''
+    returns the datetime of the digit strings of its fields, or None
+    when they are not a time that strptime would take: four digit
+    years, at most two digits for the rest
+    '''
+
+    if len(year) != 4 or max([len(f) for f in
+                             (month,day,hour,minute,second)]) > 2:
+        return None
+    (year,month,day,hour,minute,second) = [int(f) for f in
+                            (year,month,day,hour,minute,second)]
+    if (year < 1 or month < 1 or month > 12 or day < 1 or
+        day > calendar.monthrange(year,month)[1] or
+        hour > 23 or minute > 59 or second > 59):
+        return None
+    return datetime.datetime(year,month,day,hour,minute,second)
 
 inputParser = {
     'SNTT' : snttParser,
@@ -190,6 +337,35 @@ inputParser = {
     'CDL'  : cdlParser
 }
 
+# how each raw format is recognized by -I auto
+inputRE = [
+    ('SNTT', snttRE),
+    ('DTWL', dttnRE),
+    ('TVWL', tvwlRE),
+    ('CDL', cdlRE)
+]
+
+def tideFormatParser(timeFormat):
+    '''
+    wraps the tideLib parser for one of the tide formats (caris, ..)
+    so that it can be used like the parsers above. The tideLib parser
+    raises on a bad line, so this one tells only too few fields from
+    a field that is not a number or a time.
+    '''
+
+    parse = tideLib.tideParser(timeFormat)
+
+    def parser(line,D=None):
+        try:
+            (DT,WL,otherFields) = parse(line)
+        except IndexError:
+            return(None,None,noMatch)
+        except (ValueError,OverflowError):
+            return(None,None,badNumber)
+        return(DT,WL,None)
+
+    return parser
+
 
 def CommandLine():
     '''
@@ -209,9 +385,9 @@ def CommandLine():
                  ,dest='InputFormat'
                  ,type='choice'
                  ,default='SNTT'
-                 ,choices=inputParser.keys()
+                 ,choices=inputParser.keys() + ['tidebin',tideLib.autoFormat]
                  ,help= 'Input time format. One of: ' + \
-                 ', '.join(inputParser.keys()) +
+                 ', '.join(inputParser.keys() + ['tidebin',tideLib.autoFormat]) +
                  ' [default: %default] ')
     p.add_option('-o','--output-file',
                  dest='outFilename', default=None,
@@ -228,6 +404,12 @@ def CommandLine():
                  ,dest='badLineFile'
                  ,default=None,
                  help='Place unparseable lines in a file for review [default: None]')
+    p.add_option('--quarantine'
+                 ,dest='quarantineFile'
+                 ,default=None,
+                 help='write a line for each unparseable line to a file: ' +\
+                 'input file, line number, byte offset, reason and the ' +\
+                 'line, separated by tabs [default: None]')
     p.add_option('-t','--timeshift',
                  dest='timeshift', default=0
                  ,type='float'
@@ -235,6 +417,45 @@ def CommandLine():
                  'shift time for data from 2008-06-15 and ' +\
                  'older by +/- 45 seconds [default: %default]')
 
+    p.add_option('-j','--jobs',
+                 dest='jobs', default=1
+                 ,type='int'
+                 ,help='convert this many files at a time, each in its ' +\
+                 'own process; TVWL files are split into runs of days ' +\
+                 '[default: %default]')
+
+    p.add_option('--follow',
+                 dest='follow', default=False, action='store_true',
+                 help='keep converting the lines appended to the input ' +\
+                 'file, and to the files of the following days, until ' +\
+                 'interrupted')
+    p.add_option('--pollInterval',
+                 dest='pollInterval', default=0.5
+                 ,type='float'
+                 ,help='seconds between checks for new data in ' +\
+                 '--follow mode [default: %default]')
+
+    p.add_option('--state',
+                 dest='stateFile', default=None,
+                 help='keep track of what has been converted in this ' +\
+                 'file, so that a run only converts the whole lines ' +\
+                 'added since the last one and appends them to the output')
+
+    p.add_option('--demux',
+                 dest='demux', default=None,
+                 help='write the records of each SNTT station to its own ' +\
+                 'file, named by this template with %(station)s in it, ' +\
+                 'e.g. out/%(station)s.tid')
+    p.add_option('--maxOpen',
+                 dest='maxOpen', default=32
+                 ,type='int'
+                 ,help='most station files open at once with --demux ' +\
+                 '[default: %default]')
+    p.add_option('--calibration',
+                 dest='calibrationFile', default=None,
+                 help='file of per station SNTT coefficients, lines of ' +\
+                 '"station A B C [datumOffset]"')
+
     p.add_option('-v', '--verbose',
                  dest='verbose', default=False, action='store_true',
                  help='run the tests run in verbose mode')
@@ -262,84 +483,820 @@ def CommandLine():
 def main():
     """Process a list of files."""
 
-    global options, args, blf
+    global options, args, blf, qf, outputPool
     blf = None # badLineFile filePtr
+    qf = None # quarantineFile filePtr
 
     p = CommandLine()
 
+    if options.calibrationFile != None:
+        try:
+            readCalibrations(options.calibrationFile)
+        except ValueError, e:
+            p.error(str(e))
+
+    mode = 'w'
+    if options.stateFile != None:
+        mode = 'a' # carry on from the last run
+        if options.jobs > 1 or options.follow:
+            p.error('--state can not be used with --jobs or --follow')
+
+    if options.demux != None:
+        if options.jobs > 1 or options.outFilename:
+            p.error('--demux can not be used with --jobs or -o')
+        outputPool = OutputPool(options.demux,options.maxOpen,mode)
+
     out = sys.stdout
     if options.outFilename:
-        out = file(options.outFilename,'w')
+        out = file(options.outFilename,mode)
     if options.badLineFile != None:
-        blf = file(options.badLineFile,'w')
+        blf = file(options.badLineFile,mode)
+    if options.quarantineFile != None:
+        qf = file(options.quarantineFile,mode)
 
     filelist = args + options.inputFiles
 
     # statistics
-    everything = good = bad = 0
+    totals = noCounts
+
+    if options.follow:
+        if len(filelist) != 1:
+            p.error('--follow takes a single input file')
+        if options.InputFormat == tideLib.autoFormat:
+            infile = file(filelist[0])
+            (options.InputFormat,infile) = tideLib.sniffTideFormat(infile,
+                                                        rawFormats=inputRE)
+            infile.close()
+        if options.InputFormat in ['tidebin',None]:
+            p.error('--follow needs a text input format')
+        totals = follow(filelist[0],out)
+        closeOutputPool()
+        reportCounts('TOTAL',totals)
+        return
+
+    if options.stateFile != None:
+        results = convertFilesIncremental(filelist,out)
+    elif options.jobs > 1:
+        results = convertFilesParallel(filelist,out)
+    else:
+        results = ((filename,convertFile(filename,out))
+                   for filename in filelist)
 
-    for filename in filelist:
-        (a,b,g) = processFile(file(filename),out)
+    try:
+        for (filename,counts) in results:
+            reportCounts(filename,counts)
+            totals = addCounts(totals,counts)
+    except FormatError, e:
+        p.error(str(e))
 
-        sys.stderr.write('%s:: all: %d :: good: %d :: bad: %d\n' %
-                     (filename,a,g,b))
-        everything += a
-        bad += b
-        good += g
+    closeOutputPool()
+    reportCounts('TOTAL',totals)
+
+
+class FormatError(Exception):
+    '''the format of an input file could not be told'''
+    pass
+
+def convertFile(filename,out):
+    '''
+    converts one file in the input format (guessed for auto), writing
+    to out and its bad lines to blf and qf. Returns (all, bad, good,
+    reasons) counts.
+    '''
+
+    global options
+
+    inputFormat = options.InputFormat
+    infile = file(filename)
+    if inputFormat == tideLib.autoFormat:
+        (inputFormat,infile) = tideLib.sniffTideFormat(infile,
+                                                       rawFormats=inputRE)
+        if inputFormat == None:
+            raise FormatError('could not tell the format of %s' % filename)
+        if options.verbose:
+            sys.stderr.write('%s: %s format\n' % (filename,inputFormat))
+
+    if outputPool != None and inputFormat != 'SNTT':
+        raise FormatError('--demux needs SNTT input, %s is %s' %
+                          (filename,inputFormat))
+
+    if inputFormat == 'tidebin':
+        counts = processTideBin(filename,out)
+    else:
+        counts = LineConverter(inputFormat,filename).convert(infile,out)
+    infile.close()
+
+    return counts
+
+def convertFilesParallel(filelist,out):
+    '''
+    converts the files on a pool of options.jobs processes. TVWL files
+    are cut at their day header lines (see tvwlSegments) so the days of
+    one long file are converted at the same time; other files are
+    converted whole. The output and bad lines of each piece are
+    collected by its worker and written here in the order of filelist.
+    Yields (filename, counts) as each file is written.
+    '''
+
+    global options,blf,qf
+
+    pool = multiprocessing.Pool(options.jobs,
+                                initializer=setOptions,
+                                initargs=(options,))
+    try:
+        results = pool.imap(convertFileJob,parallelJobs(filelist))
+        for (index,pieces) in itertools.groupby(results,lambda r: r[0]):
+            counts = noCounts
+            for (index,filename,text,badText,quarantineText,
+                 pieceCounts) in pieces:
+                out.write(text)
+                if blf != None:
+                    blf.write(badText)
+                if qf != None:
+                    qf.write(quarantineText)
+                counts = addCounts(counts,pieceCounts)
+            yield (filename,counts)
+    finally:
+        pool.terminate()
+
+def parallelJobs(filelist):
+    '''
+    the work for convertFilesParallel: (index in filelist, filename,
+    start, end, line) with the byte range of a run of TVWL days and the
+    number of lines before it, or None for these for a whole file
+    '''
 
-    sys.stderr.write('TOTAL:: all: %d :: good: %d :: bad: %d\n' %
-                     (everything, good, bad))
+    global options
 
+    for (index,filename) in enumerate(filelist):
+        inputFormat = options.InputFormat
+        if inputFormat == tideLib.autoFormat:
+            infile = file(filename)
+            (inputFormat,infile) = tideLib.sniffTideFormat(infile,
+                                                           rawFormats=inputRE)
+            infile.close()
+        if inputFormat != 'TVWL':
+            yield (index,filename,None,None,None)
+            continue
+        for (start,end,line) in tvwlSegments(filename):
+            yield (index,filename,start,end,line)
 
-def processFile(infile,out):
+def tvwlSegments(filename):
     '''
-    process a single file
+    returns the (start, end, lines before start) byte ranges that a
+    TVWL file is cut into for convertFilesParallel. Each range but the first starts at a day
+    header line, so it converts the same on its own as it does after
+    the lines before it. Days are put together into ranges of at least
+    minSegmentSize bytes, and about options.jobs * 4 ranges in all.
     '''
 
-    global options,blf
+    global options
+
+    size = os.path.getsize(filename)
+    if size == 0:
+        return [(0,0,0)]
+    segmentSize = max(minSegmentSize,size // (options.jobs * 4))
+
+    infile = file(filename,'rb')
+    data = mmap.mmap(infile.fileno(),0,access=mmap.ACCESS_READ)
+    segments = []
+    start = line = 0
+    for match in dayHeaderRE.finditer(data):
+        if match.start() - start >= segmentSize:
+            segments.append((start,match.start(),line))
+            line += data[start:match.start()].count('\n')
+            start = match.start()
+    segments.append((start,size,line))
+    data.close()
+    infile.close()
+
+    return segments
+
+minSegmentSize = 1 << 16 # smallest run of TVWL days given to a worker
+
+def setOptions(opts):
+    '''
+    sets the options in a worker process
+    '''
+    global options
+    options = opts
+
+def convertFileJob(job):
+    '''
+    the work done for a piece by convertFilesParallel: convertFile, or
+    a LineConverter for a run of TVWL days, into strings. Returns (index,
+    filename, text, bad lines, quarantine lines, counts)
+    '''
+
+    global options,blf,qf
+
+    (index,filename,start,end,line) = job
+
+    out = cStringIO.StringIO()
+    blf = qf = None
+    if options.badLineFile != None:
+        blf = cStringIO.StringIO()
+    if options.quarantineFile != None:
+        qf = cStringIO.StringIO()
+
+    if start == None:
+        counts = convertFile(filename,out)
+    else:
+        infile = file(filename,'rb')
+        infile.seek(start)
+        segment = cStringIO.StringIO(infile.read(end - start))
+        infile.close()
+        converter = LineConverter('TVWL',filename,
+                                  BadLines(filename,line,start))
+        counts = converter.convert(segment,out)
+
+    (badText,quarantineText) = ('','')
+    if blf != None:
+        badText = blf.getvalue()
+    if qf != None:
+        quarantineText = qf.getvalue()
+    return (index,filename,out.getvalue(),badText,quarantineText,counts)
+
+
+def processSNTTFile(infile,out,bad):
+    '''
+    LineConverter.convert for SNTT input: blocks of lines are converted
+    at once by snttArrays and written with tideOutputBlock
+    '''
+
+    global options
 
-    # initialization of variables
     datalineCount = 0
-    errCount = 0
-    D = datetime.timedelta(0)
+    shift = np.timedelta64(int(round(options.timeshift * 1e6)),'us')
+
+    while True:
+        lines = list(itertools.islice(infile,tideLib.defBlockSize))
+        if len(lines) == 0:
+            break
+        text = ''.join(lines)
+        (times,WL,good,badLines,stations) = snttArrays(text)
+
+        datalineCount += len(good)
+        if len(badLines) > 0:
+            starts = np.cumsum([0] + [len(line) for line in lines])
+            for (index,reason,line) in badLines:
+                bad.add(reason,line,bad.lineNumber + index + 1,
+                        bad.offset + starts[index])
+        bad.lineNumber += len(lines)
+        bad.offset += len(text)
+
+        if outputPool != None:
+            outputPool.writeStations(stations[good],times[good] + shift,
+                                     WL[good])
+            continue
+        tideLib.tideOutputBlock(out,
+                                timeFormat=options.timeFormat,
+                                times=times[good] + shift,
+                                waterlevels=WL[good],
+                                fieldSep=options.fieldSep,
+                                recSep=options.recSep)
+
+    return bad.finish(datalineCount)
+
+
+class BadLines():
+    '''
+    The lines of an input file that could not be converted. They are
+    counted by reason and kept as (line number, byte offset, reason,
+    line) until flush or finish writes them, a block at a time: as
+    they were to the -B file and as tab separated columns to the
+    --quarantine file. lineNumber and offset are where the reading of
+    the file is up to: the number of the last line read and the
+    offset after it; the readers keep them up to date.
+    '''
+
+    def __init__(self,filename,lineNumber=0,offset=0):
+        self.filename = filename
+        self.lineNumber = lineNumber
+        self.offset = offset
+        self.reasons = {} # reason: number of lines
+        self.lines = [] # (line number, offset, reason, line)
+
+    def add(self,reason,line,lineNumber,offset):
+        '''
+        keeps a bad line
+        '''
+        self.reasons[reason] = self.reasons.get(reason,0) + 1
+        self.lines.append((lineNumber,offset,reason,line))
+        if len(self.lines) >= tideLib.defBlockSize:
+            self.flush()
+
+    def flush(self):
+        '''
+        writes the bad lines kept so far
+        '''
+
+        global options,blf,qf
+
+        if len(self.lines) == 0:
+            return
+        (lineNumbers,offsets,reasons,lines) = zip(*self.lines)
+        if blf != None:
+            blf.write(''.join(lines))
+        if qf != None:
+            filenames = [self.filename] * len(lines)
+            qf.write(''.join(map('%s\t%d\t%d\t%s\t%s\n'.__mod__,
+                                 zip(filenames,lineNumbers,offsets,reasons,
+                                     [line.rstrip('\r\n') for line in lines]))))
+        if options.verbose:
+            sys.stderr.write(''.join(['bad line: ' + line.strip() + '\n'
+                                      for line in lines]))
+        self.lines = []
+
+    def finish(self,datalineCount):
+        '''
+        flushes and returns the (all, bad, good, reasons) counts of the
+        lines since the last finish, datalineCount of them
+        '''
+        self.flush()
+        reasons = self.reasons
+        self.reasons = {}
+        errCount = sum(reasons.values())
+        return(datalineCount,errCount,datalineCount-errCount,reasons)
+
+
+class OutputPool():
+    '''
+    The per station output files of --demux, named by filling in the
+    %(station)s of a template. Records are buffered for each station
+    and written a block at a time. At most maxOpen files are open at
+    once; the least recently used one is closed to make room and
+    appended to when it is needed again.
+    '''
+
+    def __init__(self,template,maxOpen,mode='w',
+                 blockSize=tideLib.defBlockSize):
+        self.template = template
+        self.maxOpen = maxOpen
+        self.mode = mode # for the first open of each file
+        self.blockSize = blockSize
+        self.files = collections.OrderedDict() # least recently used first
+        self.opened = set() # stations with a file opened in this run
+        self.buffers = {} # station: ([times],[levels],number of records)
+        self.counts = {} # records written for each station
+
+    def writeStations(self,stations,times,levels):
+        '''
+        routes the records of a block to their stations
+        '''
+        if len(stations) == 0:
+            return
+        (names,station) = np.unique(stations,return_inverse=True)
+        for (n,name) in enumerate(names.tolist()):
+            mask = station == n
+            self.write(name,times[mask],levels[mask])
+
+    def write(self,station,times,levels):
+        '''
+        buffers records of one station
+        '''
+        (timesList,levelsList,count) = self.buffers.get(station,([],[],0))
+        timesList.append(times)
+        levelsList.append(levels)
+        count += len(times)
+        self.buffers[station] = (timesList,levelsList,count)
+        if count >= self.blockSize:
+            self.flushStation(station)
+
+    def flushStation(self,station):
+        '''
+        writes the buffered records of a station
+        '''
+        (timesList,levelsList,count) = self.buffers.pop(station,([],[],0))
+        if count == 0:
+            return
+        tideLib.tideOutputBlock(self.file(station),
+                                timeFormat=options.timeFormat,
+                                times=np.concatenate(timesList),
+                                waterlevels=np.concatenate(levelsList),
+                                fieldSep=options.fieldSep,
+                                recSep=options.recSep)
+        self.counts[station] = self.counts.get(station,0) + count
+
+    def file(self,station):
+        '''
+        the open output file of a station
+        '''
+        if station in self.files:
+            f = self.files.pop(station)
+            self.files[station] = f # now the most recently used
+            return f
+        while len(self.files) >= self.maxOpen:
+            (oldest,f) = self.files.popitem(last=False)
+            f.close()
+        mode = self.mode
+        if station in self.opened:
+            mode = 'a'
+        f = open(self.template % {'station':station},mode)
+        self.opened.add(station)
+        self.files[station] = f
+        return f
+
+    def flush(self):
+        '''
+        writes all of the buffered records
+        '''
+        for station in self.buffers.keys():
+            self.flushStation(station)
+        for f in self.files.values():
+            f.flush()
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+def closeOutputPool():
+    '''
+    writes what is left of the --demux outputs, and with -v the number
+    of records written for each station
+    '''
+    if outputPool == None:
+        return
+    outputPool.close()
+    if options.verbose:
+        for station in sorted(outputPool.counts):
+            sys.stderr.write('station %s:: %d\n' %
+                             (station,outputPool.counts[station]))
+
+def flushOutput(out):
+    '''
+    flushes out, and the station outputs of --demux
+    '''
+    out.flush()
+    if outputPool != None:
+        outputPool.flush()
 
-    # the big loop
-    for line in infile:
 
-        if commentRE.match(line): continue # skip comment lines
+def dayHeaderDate(line,D):
+    '''
+    returns the date of a day header line (Time/Date :   8 July-2009 ..)
+    or, for any other line, D
+    '''
+
+    global options
 
-        datestrMatch = dateStrRE.search(line)
+    datestrMatch = dateStrRE.search(line)
 
-        if datestrMatch != None:
-            datestr = '%s %s' % datestrMatch.groups()
-            D = datetime.datetime.strptime(datestr,'%d %B-%Y')
-            if options.verbose:
-                sys.stderr.write('DATE LINE: '+line.strip()+' -> '+
-                                 D.ctime()+'\n')
+    if datestrMatch != None:
+        datestr = '%s %s' % datestrMatch.groups()
+        D = datetime.datetime.strptime(datestr,'%d %B-%Y')
+        if options.verbose:
+            sys.stderr.write('DATE LINE: '+line.strip()+' -> '+
+                             D.ctime()+'\n')
+    return D
 
-        datalineCount += 1
 
-        (DT,WL) = inputParser[options.InputFormat](line,D)
+######################## state #########################
+def convertFilesIncremental(filelist,out):
+    '''
+    --state mode: converts only what was added to each file since the
+    last run. The state file holds, for each input file, its size and
+    mtime, the byte offset and line converted up to (always the end of
+    a whole line), its format and the date of the last TVWL day header.
+    Unchanged files are skipped; a file smaller than its offset is
+    converted again from its start. The state is saved after each
+    file. Yields (filename, counts) as convertFilesParallel does.
+    '''
+
+    global options
 
-        if(DT == None or WL == None):
-            if options.badLineFile != None:
-                blf.write(line)
-            if options.verbose:
-                sys.stderr.write('bad line: '+line.strip()+'\n')
-            errCount += 1
+    state = loadState(options.stateFile)
+
+    for filename in filelist:
+        path = os.path.abspath(filename)
+        stat = os.stat(filename)
+        entry = state.get(path)
+        if (entry != None and entry['size'] == stat.st_size and
+            entry['mtime'] == stat.st_mtime):
+            yield (filename,noCounts) # nothing new
             continue
 
+        if entry == None or stat.st_size < entry['offset']:
+            inputFormat = options.InputFormat
+            if inputFormat == tideLib.autoFormat:
+                infile = file(filename)
+                (inputFormat,infile) = tideLib.sniffTideFormat(infile,
+                                                        rawFormats=inputRE)
+                infile.close()
+                if inputFormat == None:
+                    raise FormatError('could not tell the format of %s' %
+                                      filename)
+            entry = {'offset':0, 'lines':0, 'D':None, 'format':inputFormat}
+
+        if outputPool != None and entry['format'] != 'SNTT':
+            raise FormatError('--demux needs SNTT input, %s is %s' %
+                              (filename,entry['format']))
+
+        if entry['format'] == 'tidebin':
+            counts = processTideBin(filename,out)
+            offset = stat.st_size
+        else:
+            converter = LineConverter(entry['format'],filename)
+            if entry['D'] != None:
+                converter.D = datetime.datetime.strptime(entry['D'],
+                                                         stateDateFormat)
+            converter.bad.lineNumber = entry.get('lines',0)
+            converter.bad.offset = entry['offset']
+            infile = io.open(filename,'rb')
+            infile.seek(entry['offset'])
+            (counts,offset) = convertWholeLines(infile,converter,out)
+            infile.close()
+            entry['lines'] = converter.bad.lineNumber
+            entry['D'] = None
+            if isinstance(converter.D,datetime.datetime):
+                entry['D'] = converter.D.strftime(stateDateFormat)
+
+        entry['offset'] = offset
+        entry['size'] = stat.st_size
+        entry['mtime'] = stat.st_mtime
+        state[path] = entry
+        flushOutput(out)
+        saveState(options.stateFile,state)
+
+        yield (filename,counts)
+
+stateDateFormat = '%Y-%m-%d %H:%M:%S'
+
+def convertWholeLines(infile,converter,out):
+    '''
+    converts the whole lines from the position of infile to its end
+    with converter; a last line without a newline is left for later.
+    Returns the (all, bad, good, reasons) counts and the offset after the last
+    line converted.
+    '''
+
+    counts = noCounts
+    offset = infile.tell()
+    partial = ''
+    while True:
+        data = infile.read(followReadSize)
+        if not data:
+            break
+        data = partial + data
+        end = data.rfind('\n') + 1
+        partial = data[end:]
+        if end > 0:
+            counts = addCounts(counts,
+                               converter.convert(fileLines(data[:end]),out))
+            offset += end
+
+    return (counts,offset)
+
+def fileLines(data):
+    '''
+    the lines of data as reading a file gives them, each with its
+    newline: unlike str.splitlines, split at newlines only, not at
+    \\r, \\f, \\x1c and the like
+    '''
+    return io.BytesIO(data).readlines()
+
+def loadState(stateFile):
+    '''
+    reads a --state file; an empty state if it does not exist yet
+    '''
+    if not os.path.exists(stateFile):
+        return {}
+    return json.load(open(stateFile))
+
+def saveState(stateFile,state):
+    '''
+    writes a --state file, replacing the old one only once the new
+    one is complete
+    '''
+    tmp = stateFile + '.tmp'
+    f = open(tmp,'w')
+    json.dump(state,f,indent=1,sort_keys=True)
+    f.close()
+    os.rename(tmp,stateFile)
+
+
+######################## follow ########################
+def follow(filename,out):
+    '''
+    --follow mode: converts filename and then keeps polling it,
+    converting the whole lines appended to it as they arrive and
+    flushing out after each batch. When a file of the next date
+    appears (see nextLogFile) the rest of this one is converted and
+    the new one is followed. A file that is truncated or replaced is
+    read again from its start. Runs until interrupted.
+    Returns the (all, bad, good, reasons) counts.
+    '''
+
+    global options
+
+    converter = LineConverter(options.InputFormat,filename)
+    totals = noCounts
+    fileTotals = noCounts
+    infile = io.open(filename,'rb') # no sticky end of file, unlike file()
+    partial = '' # an incomplete last line
+    nextCheck = 0 # when to look for the file of the next date again
+    try:
+        while True:
+            data = infile.read(followReadSize)
+            if data:
+                data = partial + data
+                end = data.rfind('\n') + 1
+                partial = data[end:]
+                if end > 0:
+                    counts = converter.convert(fileLines(data[:end]),out)
+                    fileTotals = addCounts(fileTotals,counts)
+                    flushOutput(out)
+                continue
+
+            stat = statOrNone(filename)
+            if stat != None and (stat.st_ino != os.fstat(infile.fileno()).st_ino
+                                 or stat.st_size < infile.tell()):
+                # replaced or truncated: start over
+                infile.close()
+                infile = io.open(filename,'rb')
+                converter = LineConverter(options.InputFormat,filename)
+                partial = ''
+                continue
+
+            # the directory is searched at most once per poll interval
+            nextName = None
+            now = time.time()
+            if now >= nextCheck:
+                nextName = nextLogFile(filename)
+                nextCheck = now + options.pollInterval
+            if nextName != None or stat == None:
+                # the logger has moved on: finish this file
+                data = partial + infile.read()
+                if data:
+                    counts = converter.convert(fileLines(data),out)
+                    fileTotals = addCounts(fileTotals,counts)
+                    flushOutput(out)
+                partial = ''
+                if nextName == None:
+                    time.sleep(options.pollInterval)
+                    continue
+                reportCounts(filename,fileTotals)
+                totals = addCounts(totals,fileTotals)
+                fileTotals = noCounts
+                infile.close()
+                filename = nextName
+                infile = io.open(filename,'rb')
+                converter = LineConverter(options.InputFormat,filename)
+                continue
+
+            time.sleep(options.pollInterval)
+
+    except KeyboardInterrupt:
+        pass
+
+    infile.close()
+    reportCounts(filename,fileTotals)
+    return addCounts(totals,fileTotals)
+
+def nextLogFile(filename):
+    '''
+    returns the first file in the same directory named like filename
+    but with a later YYYY-MM-DD date (tide-memma-2008-06-15 ->
+    tide-memma-2008-06-16), or None
+    '''
+
+    (dirname,basename) = os.path.split(filename)
+    match = logDateRE.search(basename)
+    if match == None:
+        return None
+    pattern = basename[:match.start()] + '????-??-??' + basename[match.end():]
+    later = [name for name in glob.glob(os.path.join(dirname,pattern))
+             if os.path.basename(name) > basename]
+    if len(later) == 0:
+        return None
+    return min(later)
+
+followReadSize = 1 << 20 # bytes read at a time in --follow mode
+logDateRE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+def statOrNone(filename):
+    '''
+    os.stat of filename, or None if it is not there
+    '''
+    try:
+        return os.stat(filename)
+    except OSError:
+        return None
+
+noCounts = (0,0,0,{})
+
+def addCounts(a,b):
+    '''adds (all, bad, good, reasons) counts'''
+    reasons = dict(a[3])
+    for (reason,n) in b[3].items():
+        reasons[reason] = reasons.get(reason,0) + n
+    return tuple([x + y for (x,y) in zip(a[:3],b[:3])] + [reasons])
+
+def reportCounts(filename,counts):
+    '''
+    writes the per file statistics line, and a line of the number of
+    bad lines for each reason
+    '''
+    (a,b,g,reasons) = counts
+    sys.stderr.write('%s:: all: %d :: good: %d :: bad: %d\n' %
+                     (filename,a,g,b))
+    if len(reasons) > 0:
+        sys.stderr.write('%s:: %s\n' % (filename,' :: '.join(
+                    ['%s: %d' % (reason,reasons[reason])
+                     for reason in sorted(reasons)])))
+
+class LineConverter():
+    '''
+    Converts the lines of one input file, whole or in batches, carrying
+    the date of the last day header line and the place in the file
+    (bad, a BadLines) from batch to batch. Every reader of text input
+    (whole files, runs of TVWL days, --state, --follow and tidePipeline)
+    goes through records.
+    '''
+
+    def __init__(self,inputFormat,filename,bad=None):
+        if outputPool != None and inputFormat != 'SNTT':
+            raise FormatError('--demux needs SNTT input, not ' + inputFormat)
+        self.inputFormat = inputFormat
+        if inputFormat in inputParser:
+            self.parser = inputParser[inputFormat]
+        else: # one of the tide formats
+            self.parser = tideFormatParser(inputFormat)
+        self.D = datetime.timedelta(0)
+        if bad == None:
+            bad = BadLines(filename)
+        self.bad = bad
+
+    def records(self,lines):
+        '''
+        generator over the lines that are not comments, yielding (DT,
+        WL, reason, line) as parsed by the parser of the format; DT and
+        WL are None and reason says why for lines that could not be
+        parsed, which are also added to bad. Day header lines (as for
+        TVWL) set the date handed to the parser.
+        '''
+
+        parser = self.parser
+        (lineNumber,offset) = (self.bad.lineNumber,self.bad.offset)
+        for line in lines:
+            lineNumber += 1
+            offset += len(line)
+            if tideLib.commentRE.match(line): continue # skip comment lines
+            self.D = dayHeaderDate(line,self.D)
+            (DT,WL,reason) = parser(line,self.D)
+            if reason != None:
+                self.bad.add(reason,line,lineNumber,offset - len(line))
+            yield (DT,WL,reason,line)
+        (self.bad.lineNumber,self.bad.offset) = (lineNumber,offset)
+
+    def convert(self,lines,out):
+        '''
+        converts lines (each with its newline, but the last line of a
+        file) to out. Returns the (all, bad, good, reasons) counts.
+        '''
+
+        global options
+
+        if self.inputFormat == 'SNTT':
+            return processSNTTFile(iter(lines),out,self.bad)
+
+        datalineCount = 0
+        shift = datetime.timedelta(seconds=options.timeshift)
+        writer = tideLib.BlockWriter(out,
+                                     timeFormat=options.timeFormat,
+                                     fieldSep=options.fieldSep,
+                                     recSep=options.recSep)
+        for (DT,WL,reason,line) in self.records(lines):
+            datalineCount += 1
+            if reason == None:
+                writer.write(DT + shift,WL)
+        writer.flush()
+
+        return self.bad.finish(datalineCount)
+
+
+def processTideBin(filename,out):
+    '''
+    write the records of a tidebin file in the output format
+    '''
+
+    global options
+
+    count = 0
+    for (times,levels,otherFields) in tideLib.tideBinBlocks(filename):
         if options.timeshift != 0: # shift if specified
-            DT = DT + datetime.timedelta(seconds=options.timeshift)
-            print DT
-        tideOutput(out,
-                   timeFormat=options.timeFormat,
-                   dTime=DT,
-                   waterlevel=WL,
-                   fieldSep=options.fieldSep,
-                   recSep=options.recSep)
-
-    return(datalineCount,errCount,datalineCount-errCount)
+            times = times + np.timedelta64(int(options.timeshift * 1e6),'us')
+        tideLib.tideOutputBlock(out,
+                                timeFormat=options.timeFormat,
+                                times=times,
+                                waterlevels=levels,
+                                fieldSep=options.fieldSep,
+                                recSep=options.recSep)
+        count += len(times)
+
+    return(count,0,count,{})
 
 
 if __name__ == '__main__':
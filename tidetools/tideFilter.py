@@ -8,8 +8,12 @@ The data may be of any size, but must be greater than twice the filter width.
 The output is clipped at either end of the data set by 1/2 the filter width.
 """
 
+import collections
+import cStringIO
 import datetime
 import exceptions # For KeyboardInterupt pychecker complaint
+import itertools
+import multiprocessing
 from optparse import OptionParser
 import os
 from random import *  # TODO: Do not import star.
@@ -20,6 +24,8 @@ from string import *  # TODO: Do not import star.
 import time
 import traceback
 
+import numpy as np
+
 from tideLib import *  # TODO: Do not import star.
 
 
@@ -35,7 +41,23 @@ defTimeColumn = 1
 defDataColumn = 2
 defThreshold = None
 defVerbose = False
-defDebug = 0 # binary masks are applied: i.e., 0,1,2,4,8,16
+defDebug = 0 # binary masks are applied: i.e., 0,1,2,4,8,16,32
+fftMinWidth = 400 # filters at least this wide are applied by FFT
+boxcarRebaseInterval = 1024 # values between exact recomputes of a boxcar sum
+
+# the standard tidal low pass filters (see standardFilterSpec)
+filterTypes = ['godin','doodson','butterworth']
+defCutoff = '40:00:00' # period of the Butterworth cutoff
+defOrder = 4 # of the Butterworth filter
+butterworthSpan = 4 # Butterworth kernel half width, in cutoff periods
+# Doodson X0 weights (/30) of the hourly values from the center outward
+doodsonX0 = [0,2,1,1,2,0,1,1,0,2,0,1,1,0,1,0,0,1,0,1]
+defCoverage = 0.5 # least filter weight on data for --gaps output
+thresholdSettle = 256 # values the threshold pass takes to forget its start
+chunkFilter = None # the LowPass of a --jobs worker process
+chunksInFlight = 2 # blocks per --jobs process read ahead of the output
+# standard filter specs already made, by (filterType,interval,cutoff,order)
+filterSpecs = {}
 
 def CommandLine():
     '''
@@ -61,6 +83,21 @@ element in the list and as wide as twice the description minus 1''')
                  dest="boxcarWidth",
                  help='''width of a boxcar filter.
 Use of this option supercedes the -F --filterSpec option''')
+    p.add_option("-S","--standard", type="choice", default=None,
+                 dest="standard", choices=filterTypes,
+                 help='''a standard tidal low pass filter, used instead of
+-F and -W. One of ''' + ', '.join(filterTypes))
+    p.add_option("--interval", type="string", default=None,
+                 dest="interval",
+                 help='''HH:MM:SS sampling interval the --standard filter is
+made for [default: the mode of the input file's intervals]''')
+    p.add_option("--cutoff", type="string", default=defCutoff,
+                 dest="cutoff",
+                 help='''HH:MM:SS period of the cutoff of the butterworth
+filter [default: %default]''')
+    p.add_option("--order", type="int", default=defOrder,
+                 dest="order",
+                 help="order of the butterworth filter [default: %default]")
     p.add_option("-t", "--timeCol", type="int", default=defTimeColumn,
                  dest="timeColumn",
                  help="The input column representing time")
@@ -84,6 +121,38 @@ This is used to prevent jitter.''')
                       ,choices=timeTypes
                       ,help= 'One of ' + \
                           ', '.join(timeTypes)+ ' [default: %default] ')
+    p.add_option('-I','--InputFormat'
+                      ,dest='inputFormat'
+                      ,type='choice'
+                      ,default=None
+                      ,choices=inputTypes+[autoFormat]
+                      ,help= 'Input time format, if it differs from ' + \
+                          '--timeFormat. One of ' + \
+                          ', '.join(inputTypes+[autoFormat])+ \
+                          ' [default: --timeFormat] ')
+    p.add_option("--block", action="store_true", default=False,
+                 dest="blockMode",
+                 help="read and smooth the data in blocks of records")
+    p.add_option("--batch", action="store_true", default=False,
+                 dest="batchMode",
+                 help="read all of the data and smooth it at once")
+    p.add_option("--gaps", action="store_true", default=False,
+                 dest="gapAware",
+                 help='''smooth across gaps in the data by normalized
+convolution on the grid of the --interval; records in the same slot
+of it are averaged. Not for filters with negative weights, such as
+butterworth (implies --batch)''')
+    p.add_option("--coverage", type="float", default=defCoverage,
+                 dest="coverage",
+                 help='''the least fraction of the filter weight that must
+fall on data for a --gaps value to be output [default: %default]''')
+    p.add_option("--blockSize", type="int", default=defBlockSize,
+                 dest="blockSize",
+                 help="records per block in --block mode [default: %default]")
+    p.add_option("-j", "--jobs", type="int", default=1,
+                 dest="jobs",
+                 help='''smooth this many blocks at a time, each in its own
+process (implies --block) [default: %default]''')
     p.add_option("--FieldSeperator", default = '\t',
                  type="string", dest="fieldSep",
                  help="the character(s) used to separate fields in the output; [default '\t']")
@@ -97,9 +166,27 @@ This is used to prevent jitter.''')
     (options,args) = p.parse_args()
 
     ### a few adjustments
+    if options.inputFormat == None:
+        options.inputFormat = options.timeFormat
+    if options.inputFormat == 'tidebin' and options.input == None:
+        p.error('tidebin input must be a file (-i)')
     if options.threshold != None:
         # insure we don't have neg. val
         options.threshold = abs(options.threshold)
+    if options.gapAware:
+        options.batchMode = True
+        if options.coverage <= 0:
+            p.error('--coverage must be more than 0')
+    if options.jobs > 1:
+        options.blockMode = True
+        if options.inputFormat == 'tidebin':
+            p.error('--jobs needs a text input format')
+        if options.recSep != '\n':
+            p.error('--jobs can not be used with --RecordSeperator')
+    if options.batchMode and options.blockMode:
+        p.error('--batch and --block can not be used together')
+    if options.standard != None and options.threshold != None:
+        p.error('--threshold can not be used with --standard filters')
 
     return(p)
 
@@ -110,24 +197,58 @@ def main():
 
     p = CommandLine()
 
+    # open input and output and err
+    if(options.input != None):
+        inF = open(options.input,"r")
+    else:
+        inF = sys.stdin
+
+    if options.inputFormat == autoFormat:
+        (options.inputFormat,inF) = sniffTideFormat(inF,
+                                                    options.fieldSep,
+                                                    options.recSep)
+        if options.inputFormat == None:
+            p.error('could not tell the format of the input')
+        if options.inputFormat == 'tidebin' and options.input == None:
+            p.error('tidebin input must be a file (-i)')
+
     # define the filter spec
 
-    if options.boxcarWidth != None:
+    interval = None # sampling interval, in seconds
+    if options.interval != None:
+        interval = timeStr2seconds(options.interval)
+
+    if options.standard != None:
+        if interval != None:
+            pass
+        elif options.inputFormat == 'tidebin':
+            interval = dt2fSecs(readTideBinHeader(options.input)['interval'])
+        elif options.input != None:
+            interval = dt2fSecs(sampleFileTimedelta(inF,options.inputFormat))
+        else:
+            p.error('--standard filters need an --interval to read stdin')
+        try:
+            filterSpec = standardFilterSpec(options.standard,interval,
+                                            timeStr2seconds(options.cutoff),
+                                            options.order)
+        except ValueError,e:
+            p.error(str(e))
+    elif options.boxcarWidth != None:
         filterSpec = [10] * ((options.boxcarWidth / 2) + 1 )
     elif options.filterSpecStr:
         strings = split(options.filterSpecStr)
         filterSpec = map(lambda s: int(s),strings)
     else: # not specified on command line, use default
-        filterSpec = defFilterSpec
+        filterSpec = list(defFilterSpec) # LowPass.weights takes it apart
 
     # define the filter
-    filter = LowPass(options.threshold,filterSpec)
-
-    # open input and output and err
-    if(options.input != None):
-        inF = open(options.input,"r")
-    else:
-        inF = sys.stdin
+    filter = LowPass(options.threshold,filterSpec,
+                     centered=(options.standard != None))
+    if options.standard != None and options.debug & 32:
+        checkCentered(filter,interval)
+    if options.gapAware and min(filter.weights) < 0:
+        p.error('--gaps can not be used with a filter that has negative '
+                'weights')
 
     if(options.output != None):
         outF = open(options.output,"w")
@@ -138,15 +259,59 @@ def main():
     timeIdx = options.timeColumn - 1
     dataIdx = options.dataColumn - 1
 
-    # the big loop through the data
-    for line in inF:
-        line.strip()
+    if options.batchMode:
+        blocks = list(readTideBlocks(inF,
+                                     options.inputFormat,
+                                     options.fieldSep,
+                                     options.recSep,
+                                     options.blockSize))
+        times = np.concatenate([np.empty(0,dtype='datetime64[us]')] +
+                               [b[0] for b in blocks])
+        data = np.concatenate([np.empty(0)] + [b[1] for b in blocks])
+        if options.gapAware:
+            if interval == None:
+                interval = dt2fSecs(modalTimedelta(times))
+            (outTimes,outData) = filter.smoothGaps(times,data,interval,
+                                                   options.coverage)
+        else:
+            (outTimes,outData) = filter.smoothArray(times,data)
+        tideOutputBlock(outF,
+                        timeFormat=options.timeFormat,
+                        times=outTimes,
+                        waterlevels=outData,
+                        fieldSep=options.fieldSep,
+                        recSep=options.recSep)
+        return
+
+    if options.blockMode and options.jobs > 1:
+        smoothChunks(filter,inF,outF)
+        return
+
+    if options.blockMode:
+        for (times,data,otherFields) in readTideBlocks(inF,
+                                                       options.inputFormat,
+                                                       options.fieldSep,
+                                                       options.recSep,
+                                                       options.blockSize):
+            (outTimes,outData) = filter.smoothBlock(times,data)
+            tideOutputBlock(outF,
+                            timeFormat=options.timeFormat,
+                            times=outTimes,
+                            waterlevels=outData,
+                            fieldSep=options.fieldSep,
+                            recSep=options.recSep)
+        return
+
+    writer = BlockWriter(outF,
+                         timeFormat=options.timeFormat,
+                         fieldSep=options.fieldSep,
+                         recSep=options.recSep)
 
-        # the time is in a datetime.datetime object
-        (time,data,otherFields) = findTideFields(line,
-                                                 options.timeFormat,
-                                                 options.fieldSep,
-                                                 options.recSep)
+    # the big loop through the data
+    for (time,data,otherFields) in readTideRecords(inF,
+                                                   options.inputFormat,
+                                                   options.fieldSep,
+                                                   options.recSep):
 
         # now we can apply the smoothing
         (thisTime,thisData) = filter.smooth(time,data)
@@ -158,16 +323,104 @@ def main():
             if options.debug & 4:
                 errF.write("output " +str(fieldStrs)+"\n")
 
-            tideOutput(outF,
-                       timeFormat=options.timeFormat,
-                       dTime=thisTime,
-                       waterlevel=thisData,
-                       fieldSep=options.fieldSep,
-                       recSep=options.recSep)
+            writer.write(thisTime,thisData)
 
             # else skip the line in output.. hopefully only because
             # we are at the begining or end of the data set
 
+    writer.flush()
+
+
+def smoothChunks(filter,inF,outF):
+    '''
+    --block mode on a pool of options.jobs processes. The input is cut
+    into blocks of options.blockSize lines, which the workers parse,
+    smooth and format; the text is written here in the order of the
+    input. Each block is handed the data lines before it (see
+    chunkJobs) that its first windows reach back over, and
+    thresholdSettle more, as the threshold pass started on them has
+    forgotten where it started (the weight of that value halves with
+    each value) by the time it reaches the block. The output is then
+    the same as that of a single pass. No more than chunksInFlight
+    blocks per job are read ahead of the one being written, so memory
+    stays bounded on any length of input.
+    '''
+
+    pool = multiprocessing.Pool(options.jobs,
+                                initializer=setWorker,
+                                initargs=(options,filter))
+    try:
+        pending = collections.deque()
+        for job in chunkJobs(inF,filter.listLen - 1 + thresholdSettle):
+            if len(pending) >= chunksInFlight * options.jobs:
+                outF.write(pending.popleft().get())
+            pending.append(pool.apply_async(smoothChunkJob,(job,)))
+        while pending:
+            outF.write(pending.popleft().get())
+    finally:
+        pool.terminate()
+
+def chunkJobs(inF,haloSize):
+    '''
+    the work for smoothChunks: (halo, lines) with each block of lines
+    and the last haloSize data lines before it
+    '''
+
+    halo = []
+    while True:
+        lines = list(itertools.islice(inF,options.blockSize))
+        if len(lines) == 0:
+            break
+        yield (halo,lines)
+        # only the end of the block is looked at for the next halo
+        tail = []
+        for line in reversed(lines):
+            if not skipRE.match(line):
+                tail.append(line)
+                if len(tail) == haloSize:
+                    break
+        tail.reverse()
+        halo = (halo + tail)[-haloSize:]
+
+def setWorker(opts,filter):
+    '''
+    sets the options and the filter in a worker process
+    '''
+    global options,chunkFilter
+    options = opts
+    chunkFilter = filter
+
+def smoothChunkJob(job):
+    '''
+    the work done for a block by smoothChunks: the text of the smoothed
+    records of its lines that the windows reaching back into the halo
+    lines before them give
+    '''
+
+    (halo,lines) = job
+    (haloTimes,haloData,otherFields) = tideLinesToArrays(halo,
+                                                         options.inputFormat,
+                                                         options.fieldSep)
+    (times,data,otherFields) = tideLinesToArrays(lines,
+                                                 options.inputFormat,
+                                                 options.fieldSep)
+
+    chunkFilter.resetBlock()
+    (outTimes,outData) = chunkFilter.smoothBlock(
+        np.concatenate((haloTimes,times)),np.concatenate((haloData,data)))
+    chunkFilter.resetBlock()
+    # leave out the windows that end in the halo
+    skip = max(0,len(haloData) - (chunkFilter.listLen - 1))
+
+    out = cStringIO.StringIO()
+    tideOutputBlock(out,
+                    timeFormat=options.timeFormat,
+                    times=outTimes[skip:],
+                    waterlevels=outData[skip:],
+                    fieldSep=options.fieldSep,
+                    recSep=options.recSep)
+    return out.getvalue()
+
 
 class LowPass():
     '''
@@ -213,10 +466,26 @@ class LowPass():
 
     errF = sys.stderr
 
-    def __init__(self,threshold,filterSpec):
+    def __init__(self,threshold,filterSpec,centered=False):
         self.threshold(threshold)
         self.weights(filterSpec)
         self.center = len(filterSpec) - 1
+        if centered:
+            # the standard filters: each output is at the time of the
+            # middle weight, and there is no threshold pass unless a
+            # threshold is given
+            self.center = self.listLen / 2
+            self.threshold = threshold
+
+        self.resetBlock()
+
+    def resetBlock(self):
+        '''
+        clears the state carried between blocks by smoothBlock
+        '''
+        self.blockCount = 0 # values pushed so far
+        self.blockTimes = np.empty(0,dtype='datetime64[us]')
+        self.blockValues = np.empty(0,dtype=np.float64)
 
     def threshold(self,threshold=None):
         if threshold != None:
@@ -244,54 +513,106 @@ class LowPass():
 
             self.weights = map((lambda x: float(x) / float(total)), designList)
             self.listLen = len(self.weights)
-            self.dataList = []
+            self.weightArray = np.array(self.weights)
+            self.boxcar = len(set(designList)) == 1
+            self.clear()
             if options.debug & 8:
                 errF.write("weights " + str(self.weights)+"\n")
         return self.weights
 
+    def clear(self):
+        '''
+        empties the data window. The window is a circular buffer written
+        twice over, at n and n + listLen, so that the listLen values
+        from the oldest one on are always contiguous.
+        '''
+        self.ringValues = np.zeros(2 * self.listLen)
+        self.ringTimes = [None] * self.listLen
+        self.pushed = 0 # values pushed so far
+        self.count = 0 # values in the window
+        self.windowSum = 0.0 # of the window, for a boxcar
+
+    def index(self,pos):
+        '''
+        ring index of the window position pos, counted like a list
+        (from the oldest value, or back from the newest if negative)
+        '''
+        if pos < 0:
+            pos += self.count
+        if not 0 <= pos < self.count:
+            raise IndexError('data window index out of range')
+        return (self.pushed - self.count + pos) % self.listLen
+
+    def window(self):
+        '''
+        the values in the data window, oldest first
+        '''
+        start = (self.pushed - self.count) % self.listLen
+        return self.ringValues[start:start+self.count]
+
     def push(self,value,time):
         '''
         push a new value on the list representing the current
         data window
         '''
-        self.dataList.append([value,time]) # each element is a list of two
-        # drop a value from the other end to keep the list
+        n = self.pushed % self.listLen
+        if self.boxcar:
+            if self.count == self.listLen:
+                self.windowSum -= float(self.ringValues[n])
+            self.windowSum += value
+        # drop a value from the other end to keep the window
         # the same size
-        if len(self.dataList) > self.listLen:
-            self.dataList.pop(0) # equivalent to shift, remove front element
+        self.ringValues[n] = value
+        self.ringValues[n+self.listLen] = value
+        self.ringTimes[n] = time
+        self.pushed += 1
+        self.count = min(self.count + 1,self.listLen)
+
+        if self.boxcar and self.pushed % boxcarRebaseInterval == 0:
+            # keep the rounding errors of the running sum from adding up
+            self.windowSum = float(self.window().sum())
 
         if options.debug & 16:
-            errF.write(str(self.dataList)+"\n")
+            errF.write(str(map(self.dataSet,range(self.count)))+"\n")
 
     def pop(self):
         '''
         get the last value pushed
         '''
-        return self.dataList.pop()
+        result = self.dataSet(-1)
+        self.value(-1,0.0)
+        self.pushed -= 1
+        self.count -= 1
+        return result
 
     def dataSet(self,pos):
         '''
-        returns the tuple at the position pointed to
+        returns the [value, time] at the position pointed to
         '''
-        return self.dataList[pos]
+        return [self.value(pos),self.time(pos)]
 
     def value(self,pos,val=None):
         '''
         sets the value at position indicated, if value is given.
         Always returns the value at that position
         '''
+        n = self.index(pos)
         if val != None:
-            self.dataList[pos][0] = val
-        return self.dataList[pos][0]
+            if self.boxcar:
+                self.windowSum += val - float(self.ringValues[n])
+            self.ringValues[n] = val
+            self.ringValues[n+self.listLen] = val
+        return float(self.ringValues[n])
 
     def time(self,pos,time=None):
         '''
         sets the time at position indicated, if time is given.
         Always returns the time at that position
         '''
+        n = self.index(pos)
         if time != None:
-            self.dataList[pos][1] = time
-        return self.dataList[pos][1]
+            self.ringTimes[n] = time
+        return self.ringTimes[n]
 
     def weight(self,pos):
         '''
@@ -303,18 +624,23 @@ class LowPass():
         '''
         returns the sum of the product of weights and data values
         '''
-        sum = 0.00
-        for n in range(0,self.listLen):
-            if options.debug & 8:
+        if options.debug & 8:
+            sum = 0.00
+            for n in range(0,self.listLen):
                 errF.write("(%f * %f = %f)\n" % ( self.weights[n],
-                                                   self.dataList[n][0],
+                                                   self.value(n),
                                                    self.weights[n] * \
-                                                       self.dataList[n][0]))
-            sum += self.weights[n] * self.dataList[n][0]
-
-        if options.debug & 8:
+                                                       self.value(n)))
+                sum += self.weights[n] * self.value(n)
             errF.write("SUM %f\n\n" % sum)
-        return sum
+            return sum
+
+        if self.boxcar:
+            return self.windowSum * self.weights[0]
+        # the window is a view of the ring, so nothing is copied; for
+        # equal lengths np.convolve sums with the same dot, so the
+        # block modes agree to the last bit
+        return float(np.dot(self.window(),self.weightArray))
 
     def smooth(self,time,value):
         '''
@@ -323,21 +649,266 @@ class LowPass():
         '''
 
         self.push(value,time)
+        size = self.listLen
 
         # apply threshold filter
-        if((self.threshold != None) and ( len(self.dataList) > 3)):
-            nearAvg = (self.value(-3) + self.value(-1))/2.0
+        if((self.threshold != None) and (self.count > 3)):
+            ring = self.ringValues
+            n = (self.pushed - 2) % size
+            nearAvg = (float(ring[(self.pushed - 3) % size]) + value)/2.0
             # replace previous value with nearAvg
-            self.value(-2,nearAvg)
+            if self.boxcar:
+                self.windowSum += nearAvg - float(ring[n])
+            ring[n] = nearAvg
+            ring[n+size] = nearAvg
 
         # the real filter
-        if(len(self.dataList) == self.listLen): # the data window is full
-            result = [self.dataList[self.center][1],self.avg()]
+        if(self.count == size): # the data window is full
+            result = [self.ringTimes[(self.pushed + self.center) % size],
+                      self.avg()]
         else:
             result = [None,None]
 
         return result
 
+    def smoothRecords(self,records):
+        '''
+        generator version of smooth: yields the smoothed (datetime,
+        value) for each full data window of the (datetime, value, ..)
+        records
+        '''
+
+        for record in records:
+            (thisTime,thisData) = self.smooth(record[0],record[1])
+            if (thisData != None and thisTime != None):
+                yield (thisTime,thisData)
+
+    def thresholdList(self,queue,first):
+        '''
+        applies the threshold filter of smooth to the list queue, in
+        place, as the values from position first on arrive: each value
+        is replaced by the average of its (already replaced)
+        predecessor and its successor
+        '''
+        if((self.threshold != None) and (self.listLen > 3)):
+            for n in xrange(first,len(queue)):
+                queue[n-1] = (queue[n-2] + queue[n]) / 2.0
+
+    def smoothBlock(self,times,values):
+        '''
+        block version of smooth. times (datetime64) and values are
+        arrays of consecutive data. Returns arrays of the times and
+        values that smooth would have returned for them (leaving out the
+        [None,None] results while the window fills).
+        '''
+
+        times = np.asarray(times).astype('datetime64[us]')
+        values = np.asarray(values,dtype=np.float64)
+        nHalo = len(self.blockValues)
+        qTimes = np.concatenate((self.blockTimes,times))
+        queue = np.concatenate((self.blockValues,values)).tolist()
+        # absolute position of the start of the queue
+        base = self.blockCount - nHalo
+
+        self.thresholdList(queue,max(nHalo,3 - base))
+        queue = np.array(queue)
+
+        # the real filter, for every position that fills the window
+        first = max(nHalo,self.listLen - 1 - base)
+        starts = np.arange(first,len(queue)) - (self.listLen - 1)
+        weights = np.array(self.weights)
+        if len(starts) > 0:
+            sums = convolveValid(queue[starts[0]:],weights[::-1])
+            # the newest value in each window had not been replaced yet
+            sums += weights[-1] * (values[first-nHalo:] - queue[first:])
+            # (center indexes the window like a list, it may be negative)
+            resultTimes = qTimes[starts + (self.center % self.listLen)]
+        else:
+            sums = np.empty(0,dtype=np.float64)
+            resultTimes = np.empty(0,dtype='datetime64[us]')
+
+        self.blockCount += len(values)
+        keep = min(self.listLen - 1,len(queue))
+        self.blockTimes = qTimes[len(qTimes)-keep:]
+        self.blockValues = queue[len(queue)-keep:]
+
+        return (resultTimes,sums)
+
+    def smoothArray(self,times,values):
+        '''
+        batch version of smooth: smooths all of the times (datetime64)
+        and values at once, clipping the ends as smooth does. The
+        filter is not left with any state from them.
+        '''
+
+        self.resetBlock()
+        result = self.smoothBlock(times,values)
+        self.resetBlock()
+        return result
+
+
+    def smoothGaps(self,times,values,interval,coverage=defCoverage):
+        '''
+        gap aware batch version of smooth. The times (datetime64) and
+        values are placed on a grid of interval seconds from the first
+        time, with missing slots left empty (NaN), and every window
+        position of the grid gets the weighted sum of the values
+        present divided by the sum of their weights: normalized
+        convolution. Positions where the weights of the values present
+        add up to less than coverage are left out. Values whose times
+        fall in the same slot are averaged. Without gaps the result is
+        that of smoothArray. The weights must not be negative (as those
+        of a butterworth filter are): the sum of the weights present
+        could then be near 0, or more than 1.
+        '''
+
+        if min(self.weights) < 0:
+            raise ValueError('normalized convolution needs weights that '
+                             'are not negative')
+        times = np.asarray(times).astype('datetime64[us]')
+        values = np.asarray(values,dtype=np.float64)
+        step = int(round(interval * 1e6)) # microseconds
+        if len(times) == 0 or step <= 0:
+            return (np.empty(0,dtype='datetime64[us]'),np.empty(0))
+
+        start = times.min()
+        slots = np.rint((times - start).view(np.int64) / float(step))
+        slots = slots.astype(np.int64)
+        queue = values.tolist()
+        self.thresholdList(queue,3)
+        queue = np.array(queue)
+
+        # the values of each slot used, averaged where several (repeats
+        # or jitter of half an interval) fall in the same one
+        (used,which,counts) = np.unique(slots,return_inverse=True,
+                                        return_counts=True)
+        grid = np.empty(slots.max() + 1)
+        grid.fill(np.nan)
+        grid[used] = np.bincount(which,weights=queue) / counts
+        present = ~np.isnan(grid)
+        if len(grid) < self.listLen:
+            return (np.empty(0,dtype='datetime64[us]'),np.empty(0))
+
+        weights = np.array(self.weights)
+        sums = convolveValid(np.where(present,grid,0.0),weights[::-1])
+        # the newest value in each window had not been replaced yet
+        newest = np.zeros(len(grid))
+        newest[used] = np.bincount(which,weights=values - queue) / counts
+        sums += weights[-1] * newest[self.listLen-1:]
+        cover = convolveValid(present.astype(np.float64),weights[::-1])
+
+        keep = np.flatnonzero(cover >= coverage - 1e-9) # (rounding)
+        # (center indexes the window like a list, it may be negative)
+        centers = keep + (self.center % self.listLen)
+        resultTimes = start + (centers * step).astype('timedelta64[us]')
+        return (resultTimes,sums[keep] / cover[keep])
+
+
+def checkCentered(filter,interval):
+    '''
+    checks a centered LowPass (see --standard) against the direct
+    convolution of its weights over a made up tide sampled every
+    interval seconds, and reports the largest difference to stderr.
+    Raises an AssertionError if the times are not centered or the
+    values differ.
+    '''
+
+    n = 3 * filter.listLen + 100
+    step = int(round(interval * 1e6))
+    times = np.datetime64('2000-01-01T00:00:00','us') + \
+        (np.arange(n) * step).astype('timedelta64[us]')
+    hours = np.arange(n) * interval / 3600.
+    values = np.cos(2 * np.pi * hours / 12.42) + \
+        0.3 * np.cos(2 * np.pi * hours / 25.82) + 0.01 * hours
+
+    (outTimes,outData) = filter.smoothArray(times,values)
+    expected = np.convolve(values,np.array(filter.weights),'valid')
+    half = filter.listLen / 2
+    difference = abs(outData - expected).max()
+    errF.write("centered check: %d values, largest difference %g\n" %
+               (len(outData),difference))
+    assert (outTimes == times[half:n-half]).all(), 'not centered'
+    assert difference < 1e-9, 'not the convolution of the weights'
+
+
+def standardFilterSpec(filterType,interval,cutoff=None,order=defOrder):
+    '''
+    The filterSpec (center weight first, then those on one side of it)
+    of a standard tidal low pass filter for data sampled every interval
+    seconds:
+
+      godin        the 24-24-25 hour cascade of running means. Its 25
+                   hour mean is made an odd number of samples long, so
+                   that the cascade has a center sample.
+      doodson      Doodson's X0 filter of 39 hourly values; the interval
+                   must divide an hour.
+      butterworth  the zero phase (forward and back) Butterworth filter
+                   of the given order with its cutoff at a period of
+                   cutoff seconds, cut off butterworthSpan periods from
+                   the center.
+
+    The specs are made once for each set of arguments and copies are
+    handed out, as LowPass consumes the list it is given.
+    '''
+
+    if filterType != 'butterworth':
+        (cutoff,order) = (None,None) # not used
+    key = (filterType,interval,cutoff,order)
+    if key not in filterSpecs:
+        if interval <= 0:
+            raise ValueError('the sampling interval must be positive')
+        if filterType == 'godin':
+            day = int(round(24 * 3600. / interval))
+            longDay = int(round(25 * 3600. / interval)) | 1 # odd
+            if day < 1:
+                raise ValueError('the interval is too long for a godin filter')
+            kernel = np.convolve(np.convolve(np.ones(day) / day,
+                                             np.ones(day) / day),
+                                 np.ones(longDay) / longDay)
+        elif filterType == 'doodson':
+            step = 3600. / interval
+            if step < 1 or step != int(step):
+                raise ValueError('the interval must divide an hour ' +
+                                 'for a doodson filter')
+            half = np.zeros((len(doodsonX0) - 1) * int(step) + 1)
+            half[::int(step)] = doodsonX0
+            kernel = np.concatenate((half[:0:-1],half)) / 30.
+        elif filterType == 'butterworth':
+            if cutoff == None or cutoff <= 2 * interval:
+                raise ValueError('the butterworth cutoff period must be ' +
+                                 'longer than two intervals')
+            half = int(np.ceil(butterworthSpan * cutoff / interval))
+            nfft = 1 << int(np.ceil(np.log2(16 * (half + 1))))
+            # the forward and back passes together have the square of
+            # the Butterworth gain, and no phase shift
+            freqs = np.fft.rfftfreq(nfft,interval)
+            gain = 1. / (1. + (freqs * cutoff) ** (2 * order))
+            response = np.fft.irfft(gain,nfft)
+            kernel = np.concatenate((response[half:0:-1],response[:half+1]))
+        else:
+            raise ValueError('unknown filter type %s' % filterType)
+        kernel = kernel / kernel.sum()
+        filterSpecs[key] = kernel[len(kernel) / 2:].tolist()
+    return list(filterSpecs[key])
+
+
+def convolveValid(values,kernel):
+    '''
+    np.convolve(values,kernel,'valid'), done by FFT for kernels of
+    fftMinWidth or more, where that is the quicker way
+    '''
+
+    n = len(values)
+    width = len(kernel)
+    if width < fftMinWidth or n < width:
+        return np.convolve(values,kernel,'valid')
+
+    size = n + width - 1
+    nfft = 1 << int(np.ceil(np.log2(size)))
+    full = np.fft.irfft(np.fft.rfft(values,nfft) * np.fft.rfft(kernel,nfft),
+                        nfft)
+    return full[width-1:n]
+
 
 if __name__=='__main__':
     main()
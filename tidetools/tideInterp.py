@@ -112,53 +112,8 @@ class Interpolator():
         ''' samples the time differences to find an mode of time diff '''
 
         maxSamples = 500 # for determining a true avgTinterval
-        thisdTime = lastdTime = None
-        samples = {}
-        sampleCounter = 0
-
-        inF.seek(0) # start at begining of file
-
-        for line in inF:
-            line.strip()
-
-            if ( re.search(commentRE,line) or ( re.search(blankRE,line))):
-                 continue # not a data record line
 
-            lastdTime = thisdTime
-
-            # the time is in a datetime.datetime object
-            (thisdTime,WL,otherFields) = \
-                findTideFields(line,options.timeFormat)
-
-
-            sampleCounter += 1
-            if lastdTime != None:
-                diff = (thisdTime - lastdTime).seconds
-                if samples.has_key(diff):
-                    # exists so increment
-                    samples[diff] += 1
-                else:
-                    # doesn't yet exist, initialize
-                    samples[diff] = 1
-
-            if sampleCounter >= maxSamples:
-                break
-
-        # we have our sample.. find smallest mode and rewind file
-
-        keyValues = samples.keys()
-        keyValues.sort()
-        keyValues.reverse() # so that the last value looked at is the smallest
-
-        maxCount = 0
-        modal = 0
-        for key in keyValues:
-            if samples[key] > maxCount:
-                modal = key
-                maxCount = samples[key]
-
-        inF.seek(0) # rewind
-        return(datetime.timedelta(seconds=modal))
+        return sampleFileTimedelta(inF,options.timeFormat,maxSamples)
 
     def process(self,infile,outfile):
         '''
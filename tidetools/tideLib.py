@@ -2,13 +2,20 @@
 
 import sys
 import datetime
+import errno
+import itertools
+import os
 import time
 import re
 import string
+import struct
+
+import numpy as np
 
 
 commentRE = re.compile(r"^\s*\#") # a comment line
 blankRE = re.compile(r"^\s*$") # a blank line
+skipRE = re.compile(r"^\s*(?:\#|$)") # a comment or blank line
 
 # Formats and Types
 timeFmts = {
@@ -18,16 +25,23 @@ timeFmts = {
 
 timeTypes=timeFmts.keys()+['UNIXepoch']
 
+# formats that can be read, but not written record by record
+inputTypes=timeTypes+['tidebin']
+
+# input format choice that guesses the format (see sniffTideFormat)
+autoFormat='auto'
+
 
 plotColors=['blue','red','green','orange','black']
 
 
 def sampleTimedelta(fPtr,options):
     '''
-    Reads a data file pointed to by fPtr (the file must already be open),
-    and finds the lowest mode value of time deltas. Rewinds the file
-    after sampling. If a maxSample is specified, then only that many
-    samples are taken, otherwise the entire file is read.
+    Samples the time deltas of the data file pointed to by fPtr (the
+    file must already be open, and seekable) and finds their lowest
+    mode value. Up to options.maxSamples records are read, in short
+    runs spread evenly over the whole file (see sampleFileTimedelta),
+    and the file is rewound afterwards.
 
     The value returned is a datetime.timedelta value and is found by
     looking at the statistical histogram of time deltas. This method
@@ -35,70 +49,85 @@ def sampleTimedelta(fPtr,options):
     (Perhaps we will move to "Kernel Density Estimation" if such refinement
     is needed. (Thanks to BRK for that suggestion.)
     '''
+    if options.timeFormat == 'tidebin':
+        # the interval is stored in the header
+        return readTideBinHeader(fPtr.name)['interval']
+
     maxSamples = options.maxSamples
-    timeFormat = options.timeFormat
-    fieldSep = options.fieldSep
-    recSep = options.recSep
 
     if options.debug > 0:
         print '''DEBUG:
     sampleTimedelta
       maxSamples %d \n''' % (maxSamples)
 
-    thisdTime = lastdTime = None
-    samples = {}
-    sampleCounter = 0
-    diff = 0
-
-    fPtr.seek(0) # start at begining of file
-
-    for line in fPtr:
-        line.strip()
+    modal = sampleFileTimedelta(fPtr,options.timeFormat,maxSamples)
 
-        if ( re.search(commentRE,line) or ( re.search(blankRE,line))):
-            continue # not a data record line
-
-        lastdTime = thisdTime
+    if options.debug > 0:
+        print '''DEBUG:
+    sampleTimedelta
+      modal interval %s \n''' % (modal)
 
-        # the time is in a datetime.datetime object
-        (thisdTime,WL,otherFields) = \
-            findTideFields(line,timeFormat)
+    return(modal)
 
+# sampled intervals, by (path,size,mtime,timeFormat,maxSamples)
+sampledTimedeltas = {}
+sampleRun = 10 # consecutive records read at each sampled offset
 
-        sampleCounter += 1
-        if lastdTime != None:
-            diff = (thisdTime - lastdTime).seconds
-        if samples.has_key(diff):
-            # exists so increment
-            samples[diff] += 1
-        else:
-            # doesn't yet exist, initialize
-            samples[diff] = 1
+def sampleFileTimedelta(fPtr,timeFormat,maxSamples=500):
+    '''
+    Finds the lowest mode of the positive time deltas of an open
+    file without reading all of it: runs of sampleRun records are
+    read at maxSamples/sampleRun offsets spread evenly over the file.
+    Only deltas within a run are used. Small files end up read
+    straight through. The file is rewound, and the result is kept
+    for as long as the file's size and modification time do not
+    change, so sampling the same file again is free.
+    '''
 
-        if sampleCounter >= maxSamples:
-            break
+    stat = os.fstat(fPtr.fileno())
+    key = (os.path.abspath(fPtr.name),stat.st_size,stat.st_mtime,
+           timeFormat,maxSamples)
+    if key in sampledTimedeltas:
+        return sampledTimedeltas[key]
 
-    # we have our sample.. find smallest mode and rewind file
+    parse = tideParser(timeFormat)
+    size = stat.st_size
+    runs = max(1,maxSamples / sampleRun)
+    step = max(1,size / runs)
 
-    keyValues = samples.keys()
-    keyValues.sort()
-    keyValues.reverse() # so that the last value looked at is the smallest
+    diffs = []
+    end = 0 # where the last run stopped reading
+    for offset in xrange(0,size,step):
+        if offset < end:
+            continue # already read past this offset
+        fPtr.seek(offset)
+        if offset > 0:
+            fPtr.readline() # most likely the middle of a line
+        times = []
+        while len(times) < sampleRun:
+            line = fPtr.readline()
+            if line == '':
+                break
+            if skipRE.match(line):
+                continue # not a data record line
+            times.append(parse(line)[0])
+        end = fPtr.tell()
+        if len(times) > 1:
+            diffs.append(np.diff(np.array(times,dtype='datetime64[us]')))
 
-    maxCount = 0
-    modal = 0
-    for key in keyValues:
-        if samples[key] > maxCount:
-            modal = key
-            maxCount = samples[key]
+    fPtr.seek(0) # rewind
 
-    if options.debug > 0:
-        print '''DEBUG:
-    sampleTimedelta
-      samples %d
-      modal interval %d \n''' % (sampleCounter,modal)
+    modal = datetime.timedelta(0)
+    if len(diffs) > 0:
+        diffs = np.concatenate(diffs).view(np.int64)
+        diffs = diffs[diffs > 0]
+        if len(diffs) > 0:
+            (values,counts) = np.unique(diffs,return_counts=True)
+            # unique returns sorted values, so argmax picks the smallest mode
+            modal = datetime.timedelta(microseconds=int(values[counts.argmax()]))
 
-    fPtr.seek(0) # rewind
-    return(datetime.timedelta(seconds=modal))
+    sampledTimedeltas[key] = modal
+    return modal
 
 
 ################ readTideFile  #############################
@@ -119,18 +148,322 @@ def readTideFileToLists(filename,timeFormat,
 
     infile = open(filename,"r")
 
+    parse = tideParser(timeFormat)
+
     for line in infile:
 
-        if ( re.search(commentRE,line) or ( re.search(blankRE,line))):
-                 continue
-        line.strip()
-        (DT,depth,otherFields) = findTideFields(line,timeFormat)
+        if skipRE.match(line):
+            continue
+        (DT,depth,otherFields) = parse(line)
         if(DT != None and depth != None):
             DTlist.append(DT)
             depthList.append(depth)
             otherFieldList.append(otherFields)
     return(DTlist,depthList,otherFieldList)
 
+################ readTideFileToArrays  ######################
+# the column holding the depth in each text format (time is in the
+# columns before it)
+depthColumns = {
+    'caris':2
+    ,'matlab':6
+    ,'UNIXepoch':1
+}
+
+def readTideFileToArrays(filename,timeFormat,
+                         fieldSep='\t',
+                         recSep='\n',
+                         otherFields=False):
+    '''
+    Reads date-time, tide, and (optionally) other fields from the file
+    into numpy arrays. Returns three values: times (datetime64[us]),
+    depths (float64), and a two dimensional string array of the other
+    fields, one row per record (None unless otherFields is True).
+    '''
+
+    sys.stderr.write("FILENAME: %s\n" % str(filename))
+
+    if timeFormat == 'tidebin':
+        (times,depths,header) = readTideBin(filename)
+        others = None
+        if otherFields:
+            others = np.empty((len(times),0),dtype=str)
+        return (times,depths,others)
+
+    infile = open(filename,"r")
+    text = infile.read()
+    infile.close()
+
+    return tideTextToArrays(text,timeFormat,fieldSep,recSep,otherFields)
+
+def tideTextToArrays(text,timeFormat,
+                     fieldSep='\t',
+                     recSep='\n',
+                     otherFields=False):
+    '''
+    Parses a block of text records in bulk. Comment and blank
+    lines are skipped. See readTideFileToArrays for the values returned.
+    '''
+
+    if recSep != '\n':
+        text = text.replace(recSep,'\n')
+    return tideLinesToArrays(text.splitlines(),timeFormat,fieldSep,
+                             otherFields)
+
+def tideLinesToArrays(lines,timeFormat,
+                      fieldSep='\t',
+                      otherFields=False):
+    '''
+    Parses a list of text records in bulk. Comment and blank
+    lines are skipped. See readTideFileToArrays for the values returned.
+    '''
+
+    lines = [line for line in lines
+             if line.strip() and not commentRE.match(line)]
+
+    if fieldSep == '\t' and len(lines) > 0:
+        # fast path: every record has the same number of fields, so the
+        # whole text can be split at once and folded into a table. A
+        # '\0' token between the records lands every nCols + 1 tokens
+        # only if each record has nCols fields.
+        tokens = ' \0 '.join(lines).split()
+        nCols = len(lines[0].split())
+        if (len(tokens) == (nCols + 1) * len(lines) - 1 and
+            tokens[nCols::nCols+1].count('\0') == len(lines) - 1):
+            table = np.array(tokens + ['\0']).reshape(len(lines),nCols + 1)
+            try:
+                return tideFieldsToArrays(table[:,:nCols],
+                                          timeFormat,otherFields)
+            except ValueError:
+                pass # fall through to the slow path
+
+    # slow path: split each record, pad to a table with empty strings
+    if fieldSep == '\t':
+        split = [line.split() for line in lines]
+    else:
+        split = [line.rstrip('\r\n').split(fieldSep) for line in lines]
+    nCols = max([len(fields) for fields in split] + [1])
+    rows = np.array([fields + [''] * (nCols - len(fields))
+                     for fields in split]).reshape(len(split),nCols)
+
+    return tideFieldsToArrays(rows,timeFormat,otherFields)
+
+def tideFieldsToArrays(rows,timeFormat,otherFields=False):
+    '''
+    Converts a table (2-D string array, one row per record) of tide
+    fields into times (datetime64[us]), depths (float64) and
+    optionally the remaining columns.
+    '''
+
+    depthCol = depthColumns[timeFormat]
+    if len(rows) == 0:
+        others = None
+        if otherFields:
+            others = np.empty((0,0),dtype=str)
+        return (np.empty(0,dtype='datetime64[us]'),
+                np.empty(0,dtype=np.float64),
+                others)
+
+    if timeFormat == 'caris':
+        times = carisStrs2datetime64(rows[:,0],rows[:,1])
+
+    elif timeFormat == 'matlab':
+        times = ymdhmsToDatetime64(rows[:,0].astype(np.int64),
+                                   rows[:,1].astype(np.int64),
+                                   rows[:,2].astype(np.int64),
+                                   rows[:,3].astype(np.int64),
+                                   rows[:,4].astype(np.int64),
+                                   rows[:,5].astype(np.float64))
+
+    elif timeFormat == 'UNIXepoch':
+        epoch = rows[:,0].astype(np.float64)
+        times = np.round(epoch * 1e6).astype(np.int64).astype('datetime64[us]')
+
+    depths = rows[:,depthCol].astype(np.float64)
+    others = None
+    if otherFields:
+        others = rows[:,depthCol+1:]
+
+    return (times,depths,others)
+
+def fixedDigits(strs,width,seps):
+    '''
+    Views an array of strings that should all be exactly width characters
+    long as a table of digit values (one row per string). seps is a dict
+    of position:separator character. Returns the table and a boolean
+    array which is False where a string does not match the layout.
+    '''
+    strs = np.asarray(strs)
+    if strs.dtype.kind == 'U':
+        strs = np.char.encode(strs,'ascii')
+    ok = np.char.str_len(strs) == width
+    table = np.ascontiguousarray(strs.astype('S%d' % width))
+    table = table.view(np.uint8).reshape(len(strs),width).astype(np.int64)
+    digitCols = [col for col in range(width) if col not in seps]
+    ok &= ((table[:,digitCols] >= ord('0')) &
+           (table[:,digitCols] <= ord('9'))).all(axis=1)
+    for (col,sep) in seps.items():
+        ok &= (table[:,col] == ord(sep))
+    return (table - ord('0'),ok)
+
+def carisStrs2datetime64(dates,times):
+    '''
+    Vectorized conversion of caris date (%Y/%m/%d) and time (%H:%M:%S)
+    string arrays into a datetime64[us] array. The fixed layout is
+    decoded directly from the character codes. Elements that do not
+    match the layout (or hold out of range values) are handed to
+    carisStr2datetime, which falls back to strptime.
+    '''
+    (dTab,dOk) = fixedDigits(dates,10,{4:'/',7:'/'})
+    (tTab,tOk) = fixedDigits(times,8,{2:':',5:':'})
+    Y = dTab[:,0]*1000 + dTab[:,1]*100 + dTab[:,2]*10 + dTab[:,3]
+    m = dTab[:,5]*10 + dTab[:,6]
+    d = dTab[:,8]*10 + dTab[:,9]
+    H = tTab[:,0]*10 + tTab[:,1]
+    M = tTab[:,3]*10 + tTab[:,4]
+    S = tTab[:,6]*10 + tTab[:,7]
+
+    ok = dOk & tOk & (m >= 1) & (m <= 12) & (d >= 1)
+    ok &= (H < 24) & (M < 60) & (S < 60)
+    m = np.where(ok,m,1)
+    months = ((Y - 1970) * 12 + (m - 1)).astype('datetime64[M]')
+    monthLen = ((months + 1).astype('datetime64[D]') -
+                months.astype('datetime64[D]')).astype(np.int64)
+    ok &= (d <= monthLen)
+
+    result = ymdhmsToDatetime64(Y,m,d,H,M,S)
+    for i in np.flatnonzero(~ok):
+        result[i] = carisStr2datetime(dates[i],times[i])
+    return result
+
+def carisStr2datetime(dateStr,timeStr):
+    '''
+    Converts a caris date string (%Y/%m/%d) and time string (%H:%M:%S)
+    into a datetime object by slicing the fixed layout. Anything that
+    does not match the layout is parsed with strptime.
+    '''
+    if (len(dateStr) == 10 and len(timeStr) == 8 and
+        dateStr[4] == '/' and dateStr[7] == '/' and
+        timeStr[2] == ':' and timeStr[5] == ':' and
+        (dateStr[0:4] + dateStr[5:7] + dateStr[8:10] +
+         timeStr[0:2] + timeStr[3:5] + timeStr[6:8]).isdigit()):
+        try:
+            return datetime.datetime(int(dateStr[0:4]),
+                                     int(dateStr[5:7]),
+                                     int(dateStr[8:10]),
+                                     int(timeStr[0:2]),
+                                     int(timeStr[3:5]),
+                                     int(timeStr[6:8]))
+        except ValueError:
+            pass # let strptime decide
+    return datetime.datetime.strptime(dateStr + " " + timeStr,
+                                      timeFmts['caris'])
+
+def ymdhmsToDatetime64(Y,m,d,H,M,S):
+    '''
+    Combines arrays of calendar fields into a datetime64[us] array.
+    S may be fractional.
+    '''
+    months = ((Y - 1970) * 12 + (m - 1)).astype('datetime64[M]')
+    days = months.astype('datetime64[D]') + (d - 1)
+    micros = (H * 3600 + M * 60) * 1000000 + np.round(S * 1e6).astype(np.int64)
+    return days.astype('datetime64[us]') + micros
+
+######################## readTideBlocks #####################
+defBlockSize = 65536 # records per block
+
+def readTideBlocks(inF,timeFormat,
+                   fieldSep='\t',
+                   recSep='\n',
+                   blockSize=defBlockSize,
+                   otherFields=False):
+    '''
+    Generator over an open file (or stdin) that yields blocks of
+    up to blockSize lines parsed into arrays, as (times, depths,
+    otherFields) from tideLinesToArrays. Only one block is held in
+    memory at a time, so unbounded streams can be processed.
+    '''
+
+    if timeFormat == 'tidebin':
+        for block in tideBinBlocks(inF.name,
+                                   blockSize=blockSize,
+                                   otherFields=otherFields):
+            yield block
+        return
+
+    while True:
+        lines = list(itertools.islice(inF,blockSize))
+        if len(lines) == 0:
+            break
+        if recSep != '\n':
+            lines = ''.join(lines).replace(recSep,'\n').splitlines()
+        block = tideLinesToArrays(lines,timeFormat,fieldSep,otherFields)
+        if len(block[0]) > 0:
+            yield block
+
+######################## readTideRecords ####################
+def readTideRecords(inF,timeFormat,
+                    fieldSep='\t',
+                    recSep='\n'):
+    '''
+    Generator over the data records of an open file. Comment and
+    blank lines are skipped. Yields (datetime, depth, otherFields) just
+    as findTideFields returns them. 'tidebin' files are read through
+    their memory map (see tideBinRecords).
+    '''
+
+    if timeFormat == 'tidebin':
+        for record in tideBinRecords(inF.name):
+            yield record
+        return
+
+    parse = tideParser(timeFormat,fieldSep)
+    skip = skipRE.match
+    for line in inF:
+        if skip(line):
+            continue # not a data record line
+        yield parse(line)
+
+######################## seekTideTime #######################
+def seekTideTime(inF,timeFormat,dTime,fieldSep='\t'):
+    '''
+    Positions an open file of time sorted records at the start of a
+    line, with every record before it earlier than dTime, by bisecting
+    on byte offsets. Each probe skips the rest of the line it lands
+    in and looks at the time of the next data record, so only a few
+    lines are read however large the file is. Returns the offset.
+    '''
+
+    parse = tideParser(timeFormat,fieldSep)
+
+    inF.seek(0,2)
+    lo = 0 # always 0 or the start of a line
+    hi = inF.tell()
+    while lo < hi:
+        mid = (lo + hi) / 2
+        inF.seek(mid)
+        if mid > 0:
+            inF.readline() # resync on the next record boundary
+        probeTime = None
+        while True:
+            line = inF.readline()
+            if line == '':
+                break # end of file
+            if skipRE.match(line):
+                continue # not a data record line
+            try:
+                probeTime = parse(line)[0]
+                break
+            except (ValueError,IndexError):
+                continue # not a data record either
+        if probeTime == None or dTime <= probeTime:
+            hi = mid
+        else:
+            lo = inF.tell() # past a record that is too early
+
+    inF.seek(lo)
+    return lo
+
 ######################## findTideFields #####################
 def findTideFields(line,timeFormat,
                    fieldSep='\t',
@@ -141,43 +474,158 @@ def findTideFields(line,timeFormat,
     fields
     '''
 
-    DT = None # should become a datetime object
-    depth = None # should become a float
-    fields = otherFields = []
+    return tideParser(timeFormat,fieldSep)(line)
+
+######################## tideParser #########################
+tideParsers = {} # parse functions already made, by (timeFormat,fieldSep)
+
+def tideParser(timeFormat,fieldSep='\t'):
+    '''
+    Returns a function that parses a single data line of the given
+    timeFormat and fieldSep into (datetime, depth, otherFields), as
+    findTideFields does. The separator and format are looked at once
+    here rather than for every line, so loops over many lines should
+    get the parser first and call it directly.
+    '''
+
+    key = (timeFormat,fieldSep)
+    if key in tideParsers:
+        return tideParsers[key]
 
-    if(fieldSep == '\t'):
-        fields = line.split()
+    if fieldSep == '\t':
+        split = str.split # any whitespace
     else:
-        fields = line.split(fieldSep)
+        split = lambda line: line.split(fieldSep)
 
     if timeFormat == 'caris':
-        tStr = fields[0] + " " + fields[1]
-        DT = datetime.datetime.strptime(tStr,timeFmts[timeFormat])
-        depth = float(fields[2])
-        otherFields = fields[3:]
-
-    elif timeFormat ==  'matlab':
-        Y = int(fields[0])
-        m = int(fields[1])
-        d = int(fields[2])
-        H = int(fields[3])
-        M = int(fields[4])
-        S = float(fields[5])
-        DT = datetime.datetime(year=Y
-                               ,month=m
-                               ,day=d
-                               ,hour=H
-                               ,minute=M
-                               ,second=S)
-        depth = float(fields[6])
-        otherFields = fields[7:]
+        def parse(line):
+            fields = split(line)
+            return (carisStr2datetime(fields[0],fields[1]),
+                    float(fields[2]),
+                    fields[3:])
+
+    elif timeFormat == 'matlab':
+        datetimeF = datetime.datetime
+        timedeltaF = datetime.timedelta
+        def parse(line):
+            fields = split(line)
+            DT = datetimeF(int(fields[0]),
+                           int(fields[1]),
+                           int(fields[2]),
+                           int(fields[3]),
+                           int(fields[4])) + \
+                timedeltaF(seconds=float(fields[5]))
+            return (DT,float(fields[6]),fields[7:])
 
     elif timeFormat == 'UNIXepoch':
-        DT=datetime.datetime.utcfromtimestamp(float(fields[0]))
-        depth = float(fields[1])
-        otherFields = fields[2:]
+        fromtimestamp = datetime.datetime.utcfromtimestamp
+        def parse(line):
+            fields = split(line)
+            return (fromtimestamp(float(fields[0])),
+                    float(fields[1]),
+                    fields[2:])
+
+    else:
+        def parse(line):
+            return (None,None,[])
+
+    tideParsers[key] = parse
+    return parse
+
+####################### sniffTideFormat ##############
+sniffLines = 20 # data lines looked at to guess a format
+
+def sniffTideFormat(inF,
+                    fieldSep='\t',
+                    recSep='\n',
+                    rawFormats=None):
+    '''
+    Guesses the format of an open input from its first data lines.
+    rawFormats is an optional list of (name, compiled regex) pairs
+    for other formats (tideConvert's logger formats) that are tried
+    before caris, matlab and UNIXepoch. The format matching the most
+    lines wins, the earlier one on a tie; None if nothing matched.
+
+    Returns (format, inF). Files are rewound; stdin can not be, so it
+    comes back wrapped in a ReplayFile that hands out the sniffed
+    lines again before the rest of the stream.
+    '''
+
+    try:
+        inF.seek(0,1) # before reading, as a failed seek loses buffered lines
+        seekable = True
+    except IOError: # a pipe
+        seekable = False
+
+    first = inF.readline()
+    lines = [first] + list(itertools.islice(inF,4*sniffLines))
+    if seekable:
+        inF.seek(0)
+    else:
+        inF = ReplayFile(inF,lines)
+
+    if first.startswith(tideBinMagic):
+        return ('tidebin',inF)
+
+    if recSep != '\n':
+        lines = ''.join(lines).replace(recSep,'\n').splitlines()
+    lines = [line for line in lines if not skipRE.match(line)][:sniffLines]
+
+    tests = []
+    for (name,regex) in (rawFormats or []):
+        tests.append((name,regex.search))
+    for name in ['caris','matlab','UNIXepoch']:
+        tests.append((name,tideParser(name,fieldSep)))
+
+    best = None
+    bestCount = 0
+    for (name,test) in tests:
+        count = 0
+        for line in lines:
+            try:
+                if test(line):
+                    count += 1
+            except (ValueError,IndexError,TypeError,OverflowError):
+                pass
+        if count > bestCount:
+            best = name
+            bestCount = count
+
+    return (best,inF)
+
+class ReplayFile():
+    '''
+    An open pipe with some of its lines already read; iterating or
+    readline gives those lines first and then the rest of the pipe.
+    Like the pipe, it can not seek or tell: those raise IOError.
+    '''
+
+    def __init__(self,inF,lines):
+        self.inF = inF
+        self.name = inF.name
+        self.lines = itertools.chain(lines,inF)
 
-    return(DT,depth,otherFields)
+    def __iter__(self):
+        return self.lines
+
+    def next(self):
+        return self.lines.next()
+
+    def readline(self):
+        # from the same iterator, as a file can not mix the two
+        return next(self.lines,'')
+
+    def seek(self,offset,whence=0):
+        raise IOError(errno.ESPIPE,'can not seek in %s, a pipe' % self.name)
+
+    def tell(self):
+        raise IOError(errno.ESPIPE,'no position in %s, a pipe' % self.name)
+
+    def fileno(self):
+        return self.inF.fileno()
+
+    def close(self):
+        self.inF.close()
 
 ####################### tideOutput ###################
 
@@ -210,6 +658,338 @@ def tideOutput(out,
     out.write(resultStr + recSep)
 
 
+#################### tideOutputBlock #################
+
+def tideOutputBlock(out,
+                    timeFormat,
+                    times,
+                    waterlevels,
+                    otherFields=None,
+                    fieldSep='\t',
+                    recSep='\n'):
+    '''
+    Formats and outputs a block of tide data with a single write.
+    times is an array of datetime64 (or a list of datetime objects),
+    waterlevels an array of floats and otherFields, if given, holds one
+    row of extra fields per record. The text is the same as calling
+    tideOutput for each record.
+    '''
+
+    n = len(waterlevels)
+    if n == 0:
+        return
+    timeStrs = tideTimeStrs(times,timeFormat,fieldSep)
+
+    lineFmt = '%s' + fieldSep.replace('%','%%') + '%f'
+    columns = [timeStrs,np.asarray(waterlevels,dtype=np.float64).tolist()]
+    if otherFields != None and len(otherFields) > 0:
+        otherStrs = [''.join([fieldSep + str(v) for v in row])
+                     for row in otherFields]
+        lineFmt += '%s'
+        columns.append(otherStrs)
+    lineFmt += recSep.replace('%','%%')
+
+    # one format operation over the interleaved columns
+    out.write((lineFmt * n) % tuple(itertools.chain(*zip(*columns))))
+
+def tideTimeStrs(times,timeFormat,fieldSep='\t'):
+    '''
+    Returns a list of time strings for the times (datetime64 array or
+    datetime objects) as tideOutput writes them. The strings are cut
+    from the ISO form of the whole array at once.
+    '''
+
+    us = np.asarray(times).astype('datetime64[us]')
+
+    if timeFormat == 'UNIXepoch':
+        # time.mktime takes the time as local time. The offset from UTC
+        # only changes on a quarter hour, so mktime is called once per
+        # quarter hour that appears in the block. Times within two hours
+        # of a change (skipped or repeated local times) get their own call,
+        # after one for the time before them, since the C library's
+        # choice for a repeated time depends on the previous call.
+        secs = us.astype('datetime64[s]').astype(np.int64)
+        quarters = secs // 900
+        (uniqueQs,qIdx) = np.unique(quarters,return_inverse=True)
+        def offset(q):
+            try:
+                return (int(time.mktime(time.gmtime(q * 900)[:8] + (-1,))) -
+                        q * 900)
+            except (ValueError,OverflowError):
+                return None # out of mktime's range (near 1900)
+        offsets = []
+        changing = []
+        for q in uniqueQs.tolist():
+            offsets.append(offset(q))
+            # times near the ends of mktime's range get their own call too
+            changing.append(offsets[-1] == None or
+                            offset(q - 8) != offsets[-1] or
+                            offset(q + 8) != offsets[-1])
+            if offsets[-1] == None:
+                offsets[-1] = 0
+        epochs = secs + np.array(offsets,dtype=np.int64)[qIdx]
+        for i in np.flatnonzero(np.array(changing,dtype=bool)[qIdx]):
+            if i > 0:
+                time.mktime(us[i-1].astype(datetime.datetime).timetuple())
+            epochs[i] = int(time.mktime(us[i].astype(datetime.datetime)
+                                        .timetuple()))
+        if len(epochs) > 0 and np.abs(epochs).max() >= 10**11:
+            return [str(float(e)) for e in epochs.tolist()]
+        return ['%d.0' % e for e in epochs.tolist()]
+
+    iso = np.datetime_as_string(us.astype('datetime64[s]'))
+    if iso.dtype.kind == 'U':
+        iso = np.char.encode(iso,'ascii')
+    if (np.char.str_len(iso) != 19).any():
+        # outside years 0000-9999 let strftime deal with it
+        strs = [dt.strftime(timeFmts[timeFormat])
+                for dt in us.astype(datetime.datetime)]
+        if fieldSep != '\t':
+            strs = [t.replace(' ',fieldSep) for t in strs]
+        return strs
+
+    # 'YYYY-MM-DDTHH:MM:SS' as a table of characters
+    table = np.ascontiguousarray(iso.astype('S19'))
+    table = table.view(np.uint8).reshape(len(iso),19)
+    if timeFormat == 'caris':
+        table[:,[4,7]] = ord('/')
+        table[:,10] = ord(' ')
+        strs = table.view('S19').ravel().tolist()
+        if fieldSep != '\t':
+            # substitute appropriate field separator if not standard '\t'
+            strs = [t.replace(' ',fieldSep) for t in strs]
+        return strs
+
+    elif timeFormat == 'matlab':
+        # %Y\t%m\t%d\t%H\t%M\t%S\t
+        cols = [0,1,2,3,None,5,6,None,8,9,None,11,12,None,14,15,None,17,18,None]
+        matlab = np.empty((len(iso),len(cols)),dtype=np.uint8)
+        for (i,col) in enumerate(cols):
+            if col == None:
+                matlab[:,i] = ord('\t')
+            else:
+                matlab[:,i] = table[:,col]
+        return matlab.view('S%d' % len(cols)).ravel().tolist()
+
+    raise KeyError(timeFormat)
+
+
+class BlockWriter():
+    '''
+    Collects output records one at a time and writes them
+    through tideOutputBlock every blockSize records, and on flush.
+    '''
+
+    def __init__(self,out,timeFormat,
+                 fieldSep='\t',
+                 recSep='\n',
+                 blockSize=defBlockSize):
+        self.out = out
+        self.timeFormat = timeFormat
+        self.fieldSep = fieldSep
+        self.recSep = recSep
+        self.blockSize = blockSize
+        self.reset()
+
+    def reset(self):
+        '''
+        empties the buffer
+        '''
+        self.times = []
+        self.waterlevels = []
+        self.otherFields = []
+
+    def write(self,dTime,waterlevel,otherFields=None):
+        '''
+        buffers one record (arguments as for tideOutput)
+        '''
+        self.times.append(dTime)
+        self.waterlevels.append(waterlevel)
+        self.otherFields.append(otherFields or [])
+        if len(self.times) >= self.blockSize:
+            self.flush()
+
+    def flush(self):
+        '''
+        writes out the buffered records
+        '''
+        if len(self.times) > 0:
+            otherFields = None
+            if max([len(row) for row in self.otherFields]) > 0:
+                otherFields = self.otherFields
+            tideOutputBlock(self.out,
+                            self.timeFormat,
+                            np.array(self.times,dtype='datetime64[us]'),
+                            self.waterlevels,
+                            otherFields,
+                            fieldSep=self.fieldSep,
+                            recSep=self.recSep)
+        self.reset()
+
+
+###################### tidebin ######################
+'''
+The tidebin format is a compact binary cache of a tide series. A fixed
+128 byte little-endian header is followed by two contiguous columns:
+count int64 times (microseconds since the UNIX epoch) and count water
+levels (float32 or float64). The header holds:
+
+  magic        8s   'TIDEBIN1'
+  valueType    2s   'f4' or 'f8'
+  count        q    number of records
+  interval     q    modal sampling interval in microseconds
+  minLevel     d
+  maxLevel     d
+  station      32s  station id, null padded
+'''
+
+tideBinMagic = 'TIDEBIN1'
+tideBinHeader = struct.Struct('<8s2s6xqqdd32s')
+tideBinHeaderSize = 128
+tideBinValueTypes = ['f4','f8']
+
+def modalTimedelta(times):
+    '''
+    returns the smallest of the most common differences between
+    consecutive datetime64 times as a datetime.timedelta
+    (zero if there are fewer than two times)
+    '''
+    if len(times) < 2:
+        return datetime.timedelta(0)
+    diffs = np.diff(np.asarray(times).astype('datetime64[us]').view(np.int64))
+    (values,counts) = np.unique(diffs,return_counts=True)
+    # unique returns sorted values, so argmax picks the smallest mode
+    return datetime.timedelta(microseconds=int(values[counts.argmax()]))
+
+def writeTideBin(filename,times,levels,
+                 station='',
+                 interval=None,
+                 valueType='f8'):
+    '''
+    Writes times (datetime64 or datetime objects) and water levels
+    to filename in the tidebin format. The interval (datetime.timedelta)
+    defaults to the modal interval of times. The records are stored in
+    time order (records at the same time keep their order), as
+    readTideBin finds time ranges by binary search.
+    '''
+
+    if valueType not in tideBinValueTypes:
+        raise ValueError('tidebin value type must be one of %s' %
+                         ', '.join(tideBinValueTypes))
+    times = np.asarray(times).astype('datetime64[us]').view(np.int64)
+    levels = np.asarray(levels,dtype=np.float64)
+    if len(times) != len(levels):
+        raise ValueError('times and levels must be the same length')
+    if np.any(np.diff(times) < 0):
+        order = np.argsort(times,kind='mergesort') # stable
+        (times,levels) = (times[order],levels[order])
+    if interval == None:
+        interval = modalTimedelta(times.view('datetime64[us]'))
+    if len(levels) > 0:
+        (minLevel,maxLevel) = (float(levels.min()),float(levels.max()))
+    else:
+        (minLevel,maxLevel) = (0.0,0.0)
+
+    header = tideBinHeader.pack(tideBinMagic,
+                                valueType,
+                                len(times),
+                                interval.days * 86400000000 +
+                                interval.seconds * 1000000 +
+                                interval.microseconds,
+                                minLevel,
+                                maxLevel,
+                                station[:32])
+    out = open(filename,'wb')
+    out.write(header.ljust(tideBinHeaderSize,'\0'))
+    times.astype('<i8').tofile(out)
+    levels.astype('<' + valueType).tofile(out)
+    out.close()
+
+def readTideBinHeader(filename):
+    '''
+    Reads the header of a tidebin file and returns it as a dict with
+    the keys valueType, count, interval (datetime.timedelta),
+    minLevel, maxLevel and station.
+    '''
+    inF = open(filename,'rb')
+    raw = inF.read(tideBinHeaderSize)
+    inF.close()
+    if len(raw) < tideBinHeaderSize or not raw.startswith(tideBinMagic):
+        raise ValueError('%s is not a tidebin file' % filename)
+    (magic,valueType,count,interval,minLevel,maxLevel,station) = \
+        tideBinHeader.unpack(raw[:tideBinHeader.size])
+    return {'valueType':valueType,
+            'count':count,
+            'interval':datetime.timedelta(microseconds=interval),
+            'minLevel':minLevel,
+            'maxLevel':maxLevel,
+            'station':station.rstrip('\0')}
+
+def readTideBin(filename,beginT=None,endT=None):
+    '''
+    Maps a tidebin file into memory. Returns (times, levels, header)
+    where times is a datetime64[us] array and levels a float array, both
+    backed by numpy.memmap. If beginT and/or endT (datetime objects) are
+    given, only the records between them (inclusive) are returned; the
+    bounds are found by binary search so only the pages of the selected
+    time slice are read.
+    '''
+
+    header = readTideBinHeader(filename)
+    count = header['count']
+    if count == 0:
+        return (np.empty(0,dtype='datetime64[us]'),
+                np.empty(0,dtype=np.float64),
+                header)
+
+    times = np.memmap(filename,dtype='<i8',mode='r',
+                      offset=tideBinHeaderSize,shape=(count,))
+    levels = np.memmap(filename,dtype='<' + header['valueType'],mode='r',
+                       offset=tideBinHeaderSize + 8 * count,shape=(count,))
+    first = 0
+    last = count
+    if beginT != None:
+        first = times.searchsorted(datetime64us(beginT),'left')
+    if endT != None:
+        last = times.searchsorted(datetime64us(endT),'right')
+    return (times[first:last].view('datetime64[us]'),
+            levels[first:last],
+            header)
+
+def tideBinRecords(filename,beginT=None,endT=None,blockSize=65536):
+    '''
+    Generator over the records of a tidebin file (see readTideBin).
+    Yields (datetime, depth, otherFields) like readTideRecords.
+    '''
+    (times,levels,header) = readTideBin(filename,beginT,endT)
+    for start in xrange(0,len(times),blockSize):
+        dts = times[start:start+blockSize].astype(datetime.datetime)
+        for (DT,WL) in zip(dts,levels[start:start+blockSize].tolist()):
+            yield (DT,WL,[])
+
+def tideBinBlocks(filename,beginT=None,endT=None,
+                  blockSize=defBlockSize,
+                  otherFields=False):
+    '''
+    Generator over the records of a tidebin file (see readTideBin)
+    in blocks of up to blockSize records. Yields (times, depths,
+    otherFields) like readTideBlocks.
+    '''
+    (times,depths,header) = readTideBin(filename,beginT,endT)
+    for start in xrange(0,len(times),blockSize):
+        others = None
+        if otherFields:
+            others = np.empty((min(blockSize,len(times)-start),0),dtype=str)
+        yield (times[start:start+blockSize],
+               depths[start:start+blockSize],
+               others)
+
+def datetime64us(dt):
+    '''
+    converts a datetime object into microseconds since the epoch
+    '''
+    return np.datetime64(dt,'us').astype(np.int64)
+
 def join(list,sep):
     '''
     returns a string composed of the stringified
@@ -250,6 +1030,13 @@ def datetime2epoch(dt):
     return time.mktime(dt.timetuple())
 
 
+def us2datetime(us):
+    '''
+    converts microseconds since the epoch to a datetime object
+    '''
+    return datetime.datetime(1970,1,1) + datetime.timedelta(microseconds=us)
+
+
 def epoch2datetime(et):
     '''
     converts epoch time to a datetime object
@@ -6,6 +6,7 @@ import datetime
 import os
 import sys
 from numpy import *
+import numpy as np
 from tideLib import *
 from optparse import OptionParser
 
@@ -29,9 +30,10 @@ def CommandLine():
                       ,dest='inputFormat'
                       ,type='choice'
                       ,default='caris'
-                      ,choices=timeTypes
+                      ,choices=inputTypes+[autoFormat]
                       ,help= 'Input time format. One of ' + \
-                          ', '.join(timeTypes)+ ' [default: %default] ')
+                          ', '.join(inputTypes+[autoFormat])+ \
+                          ' [default: %default] ')
     p.add_option("-o", "--outputFile",
                  default = None,
                  type="string", dest="outputFile",
@@ -70,6 +72,12 @@ Format is 'HH:MM:SS'.")
                       ,choices=timeTypes
                       ,help= 'One of ' + \
                           ', '.join(timeTypes)+ ' [default: %default] ')
+    p.add_option("--block", action="store_true", default=False,
+                 dest="blockMode",
+                 help="read the data in blocks of records")
+    p.add_option("--blockSize", type="int", default=defBlockSize,
+                 dest="blockSize",
+                 help="records per block in --block mode [default: %default]")
     p.add_option("--FieldSeperator", default = '\t',
                  type="string", dest="fieldSep",
                  help="the character(s) used to separate fields in the output; [default '\t']")
@@ -113,7 +121,16 @@ def main():
 
     for file in filelist:
         inF = open(file,"r")
-        pk.process(inF) # process the file
+        if options.inputFormat == autoFormat:
+            (pk.inputFormat,inF) = sniffTideFormat(inF)
+            if pk.inputFormat == None:
+                p.error('could not tell the format of %s' % file)
+        if options.blockMode:
+            pk.processBlocks(readTideBlocks(inF,
+                                            pk.inputFormat,
+                                            blockSize=options.blockSize))
+        else:
+            pk.process(inF) # process the file
         inF.close()
 
     outF.close()
@@ -219,6 +236,14 @@ class Peaks():
         which tide station the data represents
         '''
 
+        self.processRecords(readTideRecords(inF,self.inputFormat))
+
+    def processRecords(self,records):
+        '''
+        process for a sequence of (datetime, value, ..) records
+        rather than a file
+        '''
+
         global options
 
         thisTrend = lastTrend = None
@@ -229,15 +254,8 @@ class Peaks():
 
         # the big loop through the data
 
-        for line in inF:
-            line.strip()
-
-            if ( re.search(commentRE,line) or ( re.search(blankRE,line))):
-                 continue # not a data record line
-
-            # the time is in a datetime.datetime object
-            (thisTime,WL,otherFields) = \
-                findTideFields(line,self.inputFormat)
+        for record in records:
+            (thisTime,WL) = record[:2]
 
             winState = self.dataWindow.push(thisTime,WL)
 
@@ -281,6 +299,86 @@ class Peaks():
             lastWL = WL
             lastTrend = thisTrend
 
+    def processBlocks(self,blocks):
+        '''
+        block version of process. blocks is a sequence of (times,
+        values, otherFields) arrays from readTideBlocks. The data window
+        is kept as a range of positions in the arrays, found by binary
+        search, so the times must be in order. The output is the same as
+        that of process.
+        '''
+
+        global options
+
+        thisTrend = lastTrend = None
+        peakType = None
+        WL = lastWL = None
+        criticalT = None
+
+        widthUs = int(self.windowTwidth * 1e6)
+        writer = BlockWriter(self.output,self.outputFormat,
+                             fieldSep=options.fieldSep,
+                             recSep=options.recSep)
+
+        # the current data window, carried between blocks
+        wTimes = np.empty(0,dtype=np.int64)
+        wValues = np.empty(0,dtype=np.float64)
+
+        for (times,values,otherFields) in blocks:
+            nHalo = len(wTimes)
+            qTimes = np.concatenate(
+                (wTimes,np.asarray(times).astype('datetime64[us]').view(np.int64)))
+            qValues = np.concatenate((wValues,np.asarray(values,np.float64)))
+
+            # first position of the window that ends at each position;
+            # data once dropped from the window stays dropped
+            lows = qTimes.searchsorted(qTimes - widthUs,'left')
+            lows = np.maximum.accumulate(lows)
+            centers = (lows + (np.arange(len(qTimes)) - lows + 1) / 2).tolist()
+            tList = qTimes.tolist()
+            vList = qValues.tolist()
+            lowList = lows.tolist()
+
+            for n in xrange(nHalo,len(tList)):
+                WL = vList[n]
+
+                # threshold
+                if lastWL != None:
+                    thisTrend = lastWL - WL
+                    if (abs(thisTrend) <= self.threshold):
+                        continue
+
+                # see if the trend has switched and which direction
+                if(thisTrend > 0.0 and lastTrend < 0.0) :
+                    peakType = 'H'
+                    criticalT = tList[n]
+                    if options.debug > 0:
+                        print "High Critical ",us2datetime(criticalT), WL
+                elif(thisTrend < 0.0 and lastTrend > 0.0) :
+                    peakType = 'L'
+                    criticalT = tList[n]
+                    if options.debug > 0:
+                        print "Low Critical ",us2datetime(criticalT), WL
+
+                # if critical point is in center of window,
+                #  evaluate and output
+                if (criticalT != None and tList[centers[n]] >= criticalT):
+                    window = qValues[lowList[n]:n+1]
+                    if peakType == 'H':
+                        peak = lowList[n] + window.argmax()
+                    else:
+                        peak = lowList[n] + window.argmin()
+                    writer.write(us2datetime(tList[peak]),vList[peak],
+                                 [peakType,self.label])
+                    criticalT = None
+
+                lastWL = WL
+                lastTrend = thisTrend
+
+            wTimes = qTimes[lowList[-1]:]
+            wValues = qValues[lowList[-1]:]
+            writer.flush()
+
 
 if __name__ == '__main__':
     main()
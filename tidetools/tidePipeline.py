@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+"""Run the tide tools as a single pipeline in one process.
+
+The usual flow (see doc/TideTools.org) runs tideConvert, tideTrim,
+tideResample, tideFilter and tidePeaks one after the other, each
+writing a text file that the next one parses again. Here each tool is
+a stage: a generator of (datetime, waterlevel) records that feeds the
+next stage directly, so the data are parsed once and formatted once.
+
+    convert -> trim -> resample -> filter -> peaks
+
+Convert always runs; the other stages run when they are asked for
+(--trim or -b/-e, --resample or -T, --filter, --peaks). The records
+leaving a stage can be copied to a file with that stage's tap option
+(--convertTap, ..) to check the intermediate result with tidePlot.
+
+Example:
+
+    tidePipeline.py -I SNTT --trim -T 00:06:00 --filter \\
+        --peaks -l memma -o memma.peaks tide-memma-2008-06-15
+"""
+
+import sys
+import datetime
+import itertools
+from optparse import OptionParser
+
+import numpy as np
+
+from __init__ import __version__
+from tideLib import *
+import tideConvert
+import tideTrim
+import tideResample
+import tideFilter
+import tidePeaks
+
+
+def CommandLine():
+    '''
+    Process the command line options and arguments
+    '''
+
+    global options,args
+
+    convertTypes = tideConvert.inputParser.keys() + inputTypes + [autoFormat]
+
+    p = OptionParser(usage="%prog [options] tide files",
+                     version="%prog "+__version__)
+    p.add_option('-i','--inputFiles',
+                 dest='inputFiles',
+                 action='append',
+                 default=[],
+                 help='the files to read',
+                 metavar='FILE')
+    p.add_option('-I','--InputFormat'
+                 ,dest='inputFormat'
+                 ,type='choice'
+                 ,default=autoFormat
+                 ,choices=convertTypes
+                 ,help= 'Input format. One of: ' + \
+                     ', '.join(convertTypes) + ' [default: %default] ')
+    p.add_option('-o','--outputFile',
+                 dest='outputFile', default=None,
+                 help='the file to write to [default: stdout]',
+                 metavar='FILE')
+    p.add_option('-O','--OutputFormat'
+                 ,dest='timeFormat'
+                 ,type='choice'
+                 ,default='caris'
+                 ,choices=timeTypes
+                 ,help= 'Output time format, also used by the taps. ' + \
+                     'One of: ' + ', '.join(timeTypes)+ ' [default: %default] ')
+
+    # convert
+    p.add_option('-D','--datum-offset'
+                 ,dest='datumOffset'
+                 ,type='float'
+                 ,default=0
+                 ,help= 'Distance from the sensor up to the '+\
+                 'datum offset in meters (negative is below the '+\
+                 'sensor) [default: %default] ')
+    p.add_option('--timeshift',
+                 dest='timeshift', default=0
+                 ,type='float'
+                 ,help='in seconds (see tideConvert) [default: %default]')
+    p.add_option('-B','--BadLineFile'
+                 ,dest='badLineFile'
+                 ,default=None,
+                 help='Place unparseable lines in a file for review [default: None]')
+    p.add_option('--quarantine'
+                 ,dest='quarantineFile'
+                 ,default=None,
+                 help='write a line for each unparseable line to a file: ' +\
+                 'input file, line number, byte offset, reason and the ' +\
+                 'line, separated by tabs (see tideConvert) [default: None]')
+    p.add_option('--convertTap', default=None,
+                 dest='convertTap', metavar='FILE',
+                 help='write the converted records to FILE')
+
+    # trim
+    p.add_option('--trim', action='store_true', default=False,
+                 dest='trim',
+                 help='remove outliers (see tideTrim)')
+    p.add_option('-b', '--beginTime', default = None,
+                 type='string', dest='beginTime',
+                 help='''drop data before this time (implies --trim).
+The format is %Y/%m/%d-%H:%M:%S''')
+    p.add_option('-e', '--endTime', default = None,
+                 type='string', dest='endTime',
+                 help='''drop data after this time (implies --trim).
+The format is %Y/%m/%d-%H:%M:%S''')
+    p.add_option('-s', '--sigmas', type='float', default=1.5,
+                 dest='sigmas',
+                 help='outlier threshold in standard deviations [default: %default]')
+    p.add_option('-w', '--width', type='int', default=13,
+                 dest='width',
+                 help='samples in the outlier window [default: %default]')
+    p.add_option('-n', '--noLSR', action='store_false', default=True,
+                 dest='LSR',
+                 help='compare to the mean of the window, not the ' +\
+                 'least squares line')
+    p.add_option('-m', '--median', action='store_true', default=False,
+                 dest='median',
+                 help='compare to the median of the window, in scaled ' +\
+                 'median absolute deviations')
+    p.add_option('--trimTap', default=None,
+                 dest='trimTap', metavar='FILE',
+                 help='write the trimmed records to FILE')
+
+    # resample
+    p.add_option('--resample', action='store_true', default=False,
+                 dest='resample',
+                 help='fill gaps or downsample (see tideResample)')
+    p.add_option('-T', '--Tinterval',
+                 type='string', default=None,
+                 dest='interval',
+                 help='HH:MM:SS sampling interval (implies --resample)')
+    p.add_option('-S', '--StartTime',
+                 type='string', default='00:00:00',
+                 dest='startTime',
+                 help='HH:MM:SS for start time of resample')
+    p.add_option('-L', '--LeastSquaresAverage',
+                 action='store_true', default=False,
+                 dest='lsa',
+                 help='Use least squares averaging instead of simple averaging')
+    p.add_option('-R', '--Report',
+                 default=None, type='string',
+                 dest='reportFile', metavar='FILE',
+                 help='filename for report on points inserted into data.')
+    p.add_option('--maxSamples',
+                 type='int', default=500,
+                 dest='maxSamples',
+                 help='records looked at to find the input interval [default: %default]')
+    p.add_option('--resampleTap', default=None,
+                 dest='resampleTap', metavar='FILE',
+                 help='write the resampled records to FILE')
+
+    # filter
+    p.add_option('--filter', action='store_true', default=False,
+                 dest='filter',
+                 help='low pass filter the data (see tideFilter)')
+    p.add_option('-F', '--filterSpec', default = None,
+                 type='string', dest='filterSpecStr',
+                 help='space delimited filter weights, see tideFilter')
+    p.add_option('-W','--widthBoxcar', type='int', default=None,
+                 dest='boxcarWidth',
+                 help='width of a boxcar filter; supercedes --filterSpec')
+    p.add_option('--filterThreshold', type='int', default=None,
+                 dest='threshold',
+                 help='minimum change required to trigger smoothing')
+    p.add_option('--filterTap', default=None,
+                 dest='filterTap', metavar='FILE',
+                 help='write the filtered records to FILE')
+
+    # peaks
+    p.add_option('--peaks', action='store_true', default=False,
+                 dest='peaks',
+                 help='output only the highs and lows (see tidePeaks)')
+    p.add_option('-l', '--label',
+                 default = None,
+                 type='string', dest='label',
+                 help='the label (station ID) to add to each peak')
+    p.add_option('--window',
+                 default = '01:00:00',
+                 type='string', dest='windowTstr',
+                 help="the time window in which to find peak values. " + \
+                     "Format is 'HH:MM:SS'. [default: %default]")
+    p.add_option('--peakThreshold', type='float', default=0.005,
+                 dest='peakThreshold',
+                 help='minimum change to count as a trend [default: %default]')
+
+    p.add_option('-X', '--debug', type='int', default=0,
+                 dest='debug',
+                 help='debug level: 0 is off; powers of 2 for levels')
+    p.add_option('-v', '--verbose', action='store_true', default=False,
+                 dest='verbose',
+                 help='report record counts for each stage')
+    p.add_option("--FieldSeparator", default = '\t',
+                 type="string", dest="fieldSep",
+                 help="the character(s) used to separate fields in the output; [default '\\t']")
+    p.add_option("--RecordSeparator", default = '\n',
+                 type="string", dest="recSep",
+                 help="the character(s) used to separate records in the output; [default '\\n']")
+
+    (options,args) = p.parse_args()
+
+    if options.beginTime != None or options.endTime != None:
+        options.trim = True
+    if options.interval != None:
+        options.resample = True
+    options.window = timeStr2seconds(options.windowTstr)
+
+    return(p)
+
+
+def main():
+
+    global options, args
+
+    p = CommandLine()
+
+    filelist = args + options.inputFiles
+    if len(filelist) == 0:
+        p.error('no input files')
+
+    # the stages read their settings from the options of their module
+    for module in [tideConvert,tideTrim,tideResample,tideFilter,tidePeaks]:
+        module.options = options
+    (tideConvert.blf,tideConvert.qf) = (None,None)
+    if options.badLineFile != None:
+        tideConvert.blf = file(options.badLineFile,'w')
+    if options.quarantineFile != None:
+        tideConvert.qf = file(options.quarantineFile,'w')
+    if options.reportFile != None:
+        tideResample.reportF = open(options.reportFile,'w')
+
+    if(options.outputFile != None):
+        outF = open(options.outputFile,"w")
+    else:
+        outF = sys.stdout
+
+    records = tap(convertFiles(filelist,p),options.convertTap,'convert')
+
+    if options.trim:
+        beginDT = endDT = None
+        if(options.beginTime != None):
+            beginDT = datetime.datetime.strptime(options.beginTime,
+                                                 tideTrim.cmdLineDTformat)
+        if(options.endTime != None):
+            endDT = datetime.datetime.strptime(options.endTime,
+                                               tideTrim.cmdLineDTformat)
+        trim = tideTrim.Trim(beginDT,endDT,options.sigmas,options.width)
+        records = tap(trim.testRecords(records),options.trimTap,'trim')
+
+    if options.resample:
+        records = tap(resampleRecords(records),options.resampleTap,'resample')
+
+    if options.filter:
+        if options.boxcarWidth != None:
+            filterSpec = [10] * ((options.boxcarWidth / 2) + 1 )
+        elif options.filterSpecStr:
+            filterSpec = [int(s) for s in options.filterSpecStr.split()]
+        else:
+            # a copy, as LowPass.weights takes it apart
+            filterSpec = list(tideFilter.defFilterSpec)
+        lowPass = tideFilter.LowPass(options.threshold,filterSpec)
+        records = tap(lowPass.smoothRecords(records),options.filterTap,'filter')
+
+    if options.peaks:
+        pk = tidePeaks.Peaks(output = outF,
+                             label = options.label,
+                             threshold = options.peakThreshold,
+                             inputFormat = None,
+                             outputFormat = options.timeFormat,
+                             window = options.window)
+        pk.processRecords(records)
+    else:
+        writer = BlockWriter(outF,
+                             timeFormat=options.timeFormat,
+                             fieldSep=options.fieldSep,
+                             recSep=options.recSep)
+        for (dt,value) in records:
+            writer.write(dt,value)
+        writer.flush()
+
+    outF.close()
+
+
+def convertFiles(filelist,p):
+    '''
+    the convert stage: generator of the (datetime, waterlevel) records
+    of each file in turn, in its own format (guessed for -I auto)
+    '''
+
+    global options
+
+    for filename in filelist:
+        inputFormat = options.inputFormat
+        infile = file(filename)
+        if inputFormat == autoFormat:
+            (inputFormat,infile) = sniffTideFormat(infile,
+                                        rawFormats=tideConvert.inputRE)
+            if inputFormat == None:
+                p.error('could not tell the format of %s' % filename)
+
+        converter = None
+        if inputFormat == 'tidebin':
+            lines = ((dt,value,None,None) for (dt,value,otherFields)
+                     in tideBinRecords(filename))
+        else:
+            # the bad lines go to tideConvert's -B file
+            converter = tideConvert.LineConverter(inputFormat,filename)
+            lines = converter.records(infile)
+
+        shift = datetime.timedelta(seconds=options.timeshift)
+        good = bad = 0
+        for (DT,WL,reason,line) in lines:
+            if reason != None:
+                bad += 1
+                continue
+            good += 1
+            yield (DT + shift,WL)
+        infile.close()
+        if converter != None:
+            converter.bad.finish(good + bad)
+
+        if options.verbose:
+            sys.stderr.write('%s: %s :: good: %d :: bad: %d\n' %
+                             (filename,inputFormat,good,bad))
+
+
+def resampleRecords(records):
+    '''
+    the resample stage: finds the interval of the first records, then
+    interpolates gaps or downsamples just as tideResample does
+    '''
+
+    global options
+
+    # look at the time interval of the data
+    head = list(itertools.islice(records,options.maxSamples))
+    dtInterval = modalTimedelta(np.array([r[0] for r in head],
+                                         dtype='datetime64[us]'))
+    records = itertools.chain(head,records)
+
+    if options.interval != None:
+        dtIntervalSpec = datetime.timedelta(seconds =
+                                            timeStr2seconds(options.interval))
+    else:
+        dtIntervalSpec = datetime.timedelta(seconds = 0 )
+    dtStartTime = datetime.timedelta(seconds=timeStr2seconds(options.startTime))
+
+    if dtIntervalSpec <= dtInterval:
+        resampler = tideResample.Interpolator(iTformat=options.timeFormat,
+                                              oTformat=options.timeFormat,
+                                              dtStart=dtStartTime,
+                                              dtInterval=dtInterval)
+    else:
+        resampler = tideResample.Downsampler(iTformat=options.timeFormat,
+                                             oTformat=options.timeFormat,
+                                             dtStart=dtStartTime,
+                                             dtInterval=dtIntervalSpec)
+    return resampler.resample(records)
+
+
+def tap(records,filename,stage):
+    '''
+    passes the records on, writing a copy of them to filename if it is
+    given. With --verbose the records are counted.
+    '''
+
+    global options
+
+    if filename == None and not options.verbose:
+        return records
+    return tapRecords(records,filename,stage)
+
+def tapRecords(records,filename,stage):
+    '''
+    generator for tap
+    '''
+
+    global options
+
+    writer = None
+    if filename != None:
+        writer = BlockWriter(open(filename,'w'),
+                             timeFormat=options.timeFormat,
+                             fieldSep=options.fieldSep,
+                             recSep=options.recSep)
+    count = 0
+    for record in records:
+        if writer != None:
+            writer.write(record[0],record[1])
+        count += 1
+        yield record
+
+    if writer != None:
+        writer.flush()
+        writer.out.close()
+    if options.verbose:
+        sys.stderr.write('%s: %d records\n' % (stage,count))
+
+
+if __name__ == '__main__':
+    main()
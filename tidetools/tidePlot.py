@@ -52,9 +52,9 @@ def CommandLine():
                       ,dest='timeFormat'
                       ,type='choice'
                       ,default='caris'
-                      ,choices=timeTypes
+                      ,choices=inputTypes
                       ,help= 'One of ' + \
-                          ', '.join(timeTypes)+ ' [default: %default] ')
+                          ', '.join(inputTypes)+ ' [default: %default] ')
 
     (options,args) = parser.parse_args()
 
@@ -80,7 +80,7 @@ def main():
 
     for filename in inputFiles:
 
-        (times,data,otherFields) = readTideFileToLists(filename=filename
+        (times,data,otherFields) = readTideFileToArrays(filename=filename
                                 ,timeFormat = options.timeFormat)
 
         ax.plot(times,data,'.-',
@@ -31,9 +31,10 @@ def CommandLine():
                       ,dest='timeFormat'
                       ,type='choice'
                       ,default='caris'
-                      ,choices=timeTypes
-                      ,help= 'Output time format. One of ' + \
-                          ', '.join(timeTypes)+ ' [default: %default] ')
+                      ,choices=inputTypes+[autoFormat]
+                      ,help= 'Input time format. One of ' + \
+                          ', '.join(inputTypes+[autoFormat])+ \
+                          ' [default: %default] ')
 
     p.add_option("-o", "--outputFile",
                  default = None,
@@ -99,9 +100,10 @@ to determine the modal time interval''')
                       ,dest='timeFormat'
                       ,type='choice'
                       ,default='caris'
-                      ,choices=timeTypes
+                      ,choices=inputTypes+[autoFormat]
                       ,help= 'One of ' + \
-                          ', '.join(timeTypes)+ ' [default: %default] ')
+                          ', '.join(inputTypes+[autoFormat])+ \
+                          ' [default: %default] ')
 
     p.add_option("--FieldSeperator",
                  default = '\t',
@@ -154,10 +156,17 @@ def main():
     # process the input files
     filelist = args + options.inputFiles
 
+    sniff = (options.timeFormat == autoFormat)
+
     fileCount = 0
     for file in filelist:
         inF = open(file,"r")
 
+        if sniff: # guess the input format of each file
+            (options.timeFormat,inF) = sniffTideFormat(inF)
+            if options.timeFormat == None:
+                p.error('could not tell the format of %s' % file)
+
         # look at the time interval used by the file
         dtInterval = sampleTimedelta(inF,options)
 
@@ -237,6 +246,20 @@ class Interpolator():
 
         global options
 
+        writer = BlockWriter(outfile,self.oTformat)
+        for (dt,value) in self.resample(readTideRecords(inF,options.timeFormat)):
+            writer.write(dt,value)
+        writer.flush()
+
+    def resample(self,records):
+        '''
+        generator version of process: yields the (datetime, value) of
+        each of the (datetime, value, ..) records, along with the
+        values interpolated into any gaps
+        '''
+
+        global options
+
         if options.debug > 0:
             print '''DEBUG:
     Interpolator
@@ -255,18 +278,13 @@ class Interpolator():
         tdMaxInt = datetime.timedelta(seconds=(tdAvgInt.seconds*(1+tolerance)))
 
         # the big loop through the data
-        for line in inF:
-            line.strip()
-
-            if ( re.search(commentRE,line) or ( re.search(blankRE,line))):
-                 continue # not a data record line
+        for record in records:
 
             lastdTime = thisdTime
             lastWL = WL
 
             # the time is in a datetime.datetime object
-            (thisdTime,WL,otherFields) = \
-                findTideFields(line,options.timeFormat)
+            (thisdTime,WL) = record[:2]
 
             if lastdTime != None:
                 dtDiff = thisdTime - lastdTime
@@ -313,8 +331,8 @@ class Interpolator():
                         reportF.write(
                             "%d missing data points from %s to %s\n" %
                             (missingTs,
-                             lastdTime.strftime(timeFmts[options.timeFormat]),
-                             thisdTime.strftime(timeFmts[options.timeFormat])))
+                             lastdTime.strftime(timeFmts[self.oTformat]),
+                             thisdTime.strftime(timeFmts[self.oTformat])))
 
                     # calculate WLstep
                     WLstep = WLdiff / float(missingTs)
@@ -338,18 +356,12 @@ class Interpolator():
                             # print the results
                             if options.debug > 0:
                                 print "filing ", interpDT
-                            tideOutput(outfile,
-                                   options.timeFormat,
-                                   interpDT,
-                                   interpWL)
+                            yield (interpDT,interpWL)
 
             # continue with uninterpolated data output
                             if options.debug > 0:
                                 print "normal", thisdTime
-            tideOutput(outfile,
-                       options.timeFormat,
-                       thisdTime,
-                       WL)
+            yield (thisdTime,WL)
 
 
 class Downsampler():
@@ -412,6 +424,22 @@ class Downsampler():
 
         global options
 
+        writer = BlockWriter(outfile,
+                             timeFormat=self.oTformat,
+                             fieldSep=options.fieldSep,
+                             recSep=options.recSep)
+        for (dt,value) in self.resample(readTideRecords(inF,self.iTformat)):
+            writer.write(dt,value)
+        writer.flush()
+
+    def resample(self,records):
+        '''
+        generator version of process: yields the (datetime, value)
+        aligned to each output time of the (datetime, value, ..) records
+        '''
+
+        global options
+
         if options.debug > 0:
             print '''DEBUG:
     Downsampler
@@ -420,13 +448,8 @@ class Downsampler():
         lastOutputDT = None # used to keep track of what's been done
 
         # the big loop through the data
-        for line in inF:
-            line.strip()
-
-            if ( re.search(commentRE,line) or ( re.search(blankRE,line))):
-                 continue # not a data record line
-
-            (dt,value,otherFields) = findTideFields(line,self.iTformat)
+        for record in records:
+            (dt,value) = record[:2]
             if self.dtStart == None:
                 # start timedate is set to begining of first day of data
                 self.startTD = datetime.datetime(year=dt.year,
@@ -446,12 +469,7 @@ class Downsampler():
                 # nextOutputTime
                 (otime,ovalue) = self.align(outputDT)
                 if(ovalue != None):
-                    tideOutput(outfile,
-                               timeFormat=self.oTformat,
-                               dTime=otime,
-                               waterlevel=ovalue,
-                               fieldSep=options.fieldSep,
-                               recSep=options.recSep)
+                    yield (otime,ovalue)
 
                 self.reset()
                 lastOutputDT = outputDT # mark this one done
@@ -3,6 +3,9 @@
 
 import sys
 import os
+import calendar
+import itertools
+import math
 import string
 import time
 import datetime
@@ -17,6 +20,7 @@ from random import *
 import re
 
 from numpy import *
+import numpy as np
 
 ## local import
 from tideLib import *
@@ -31,6 +35,9 @@ defDebug = 0 # binary masks are applied: i.e., 0,1,2,4,8,16
 
 cmdLineDTformat = '%Y/%m/%d-%H:%M:%S'
 
+lsrRebaseInterval = 1024 # records between exact recomputes of the LSR sums
+windowChunkValues = 1 << 20 # window values gathered at once by Trim.retest
+
 def CommandLine():
     '''
     Process the command line options and arguments
@@ -68,6 +75,11 @@ width (see -w --width), default is 1.5 sigma''')
     p.add_option("-n", "--noLSR", action="store_false", default=True,
                  dest="LSR",
                  help="no LSR - use simple statistics")
+    p.add_option("-m", "--median", action="store_true", default=False,
+                 dest="median",
+                 help='''robust statistics: compare values to the median of
+the window, with sigmas of 1.4826 median absolute deviations
+(overrides --LSR and --noLSR)''')
     p.add_option('-B','--BadDataFile'
                  ,dest='badDataFile'
                  ,default=None,
@@ -85,6 +97,34 @@ width (see -w --width), default is 1.5 sigma''')
                       ,choices=timeTypes
                       ,help= 'One of ' + \
                           ', '.join(timeTypes)+ ' [default: %default] ')
+    p.add_option('-I','--InputFormat'
+                      ,dest='inputFormat'
+                      ,type='choice'
+                      ,default=None
+                      ,choices=inputTypes+[autoFormat]
+                      ,help= 'Input time format, if it differs from ' + \
+                          '--timeFormat. One of ' + \
+                          ', '.join(inputTypes+[autoFormat])+ \
+                          ' [default: --timeFormat] ')
+    p.add_option("--sorted", action="store_true", default=False,
+                 dest="sortedInput",
+                 help='''the input file is in time order: seek straight
+to --beginTime and stop reading after --endTime. Records outside of
+the window are then not counted or written to the bad data file''')
+    p.add_option("--block", action="store_true", default=False,
+                 dest="blockMode",
+                 help="read and test the data in blocks of records")
+    p.add_option("--batch", action="store_true", default=False,
+                 dest="batchMode",
+                 help='''read all of the data and test it at once, each
+record against the window centered on it (see Trim.keepMask)''')
+    p.add_option("--iterate", action="store_true", default=False,
+                 dest="iterate",
+                 help='''repeat the outlier test on what is left until it
+removes nothing more (implies --batch)''')
+    p.add_option("--blockSize", type="int", default=defBlockSize,
+                 dest="blockSize",
+                 help="records per block in --block mode [default: %default]")
     p.add_option("--FieldSeparator", default = '\t',
                  type="string", dest="fieldSep",
                  help="the character(s) used to separate fields in the output; [default '\\t']")
@@ -96,6 +136,17 @@ width (see -w --width), default is 1.5 sigma''')
 
     (options,args) = p.parse_args()
 
+    if options.inputFormat == None:
+        options.inputFormat = options.timeFormat
+    if options.inputFormat == 'tidebin' and options.input == None:
+        p.error('tidebin input must be a file (-i)')
+    if options.sortedInput and options.input == None:
+        p.error('--sorted needs an input file (-i)')
+    if options.iterate:
+        options.batchMode = True
+    if options.batchMode and options.blockMode:
+        p.error('--batch and --block can not be used together')
+
     return(p)
 
 
@@ -129,25 +180,49 @@ def main():
     else:
         inF = sys.stdin
 
+    if options.inputFormat == autoFormat:
+        (options.inputFormat,inF) = sniffTideFormat(inF,
+                                                    options.fieldSep,
+                                                    options.recSep)
+        if options.inputFormat == None:
+            p.error('could not tell the format of the input')
+        if options.inputFormat == 'tidebin' and options.input == None:
+            p.error('tidebin input must be a file (-i)')
+
+    if (options.sortedInput and beginDT != None and
+        options.inputFormat != 'tidebin'):
+        seekTideTime(inF,options.inputFormat,beginDT,options.fieldSep)
+
     if(options.output != None):
         outF = open(options.output,"w")
     else:
         outF = sys.stdout
 
+    bdf = None
     if options.badDataFile != None:
         bdf = file(options.badDataFile,'w')
 
 
 
-    # the big loop through the data
-    for line in inF:
-        line.strip()
+    if options.batchMode:
+        (goodCntr,badCntr) = trimBatch(trim,inF,outF,bdf,beginDT,endDT)
+        records = [] # nothing left for the big loop
+    elif options.blockMode:
+        (goodCntr,badCntr) = trimBlocks(trim,inF,outF,bdf,beginDT,endDT)
+        records = [] # nothing left for the big loop
+    elif options.inputFormat == 'tidebin':
+        # only the pages within the time window are read
+        records = itertools.izip(tideBinRecords(options.input,beginDT,endDT),
+                                 itertools.repeat(None))
+    else:
+        records = recordLines(inF)
+        if options.sortedInput and endDT != None:
+            # nothing after endTime can pass
+            records = itertools.takewhile(lambda r: r[0][0] <= endDT,
+                                          records)
 
-        # the time is in a datetime.datetime object
-        (time,data,otherFields) = findTideFields(line,
-                                                 options.timeFormat,
-                                                 options.fieldSep,
-                                                 options.recSep)
+    # the big loop through the data
+    for ((time,data,otherFields),line) in records:
 
         (oTime,oData) = trim.test(time,data)
         if(oTime != None) and (oData != None):
@@ -160,14 +235,463 @@ def main():
             goodCntr += 1
         else:         # else skip the line in output
             badCntr += 1
-            if options.badDataFile != None:
+            if options.badDataFile != None and line != None:
                 bdf.write(line)
+            elif options.badDataFile != None: # tidebin has no lines
+                tideOutput(bdf,
+                           timeFormat=options.timeFormat,
+                           dTime=time,
+                           waterlevel=data,
+                           otherFields=otherFields,
+                           fieldSep=options.fieldSep,
+                           recSep=options.recSep)
 
     inF.close()
     outF.close()
     if options.verbose:
         sys.stderr.write("%d good records; %d bad records\n" % (goodCntr,badCntr))
+        sys.stderr.write("%d rejected as outliers\n" % trim.rejected)
+        if options.iterate:
+            sys.stderr.write("%d passes\n" % trim.passes)
+
+
+def trimBlocks(trim,inF,outF,bdf=None,beginDT=None,endDT=None):
+    '''
+    block mode of main: reads the input in blocks of records and
+    tests each block at once with Trim.testBlock. Rejected records
+    go to bdf if it is given. Returns the number of good and bad records.
+    '''
+
+    goodCntr = badCntr = 0
+
+    for (times,data,otherFields,lines) in inputBlocks(inF,beginDT,endDT):
+        (goodTimes,goodData,badTimes,badData,badIdx) = trim.testBlock(times,
+                                                                      data)
+        goodCntr += len(goodTimes)
+        badCntr += len(badTimes)
+        tideOutputBlock(outF,
+                        timeFormat=options.timeFormat,
+                        times=goodTimes,
+                        waterlevels=goodData,
+                        fieldSep=options.fieldSep,
+                        recSep=options.recSep)
+        if bdf != None:
+            writeBad(bdf,lines,badIdx,badTimes,badData)
+
+    return (goodCntr,badCntr)
+
+
+def trimBatch(trim,inF,outF,bdf=None,beginDT=None,endDT=None):
+    '''
+    batch mode of main: reads all of the input and tests it at once
+    with Trim.keepMask. Rejected records go to bdf if it is given.
+    Returns the number of good and bad records.
+    '''
+
+    blocks = list(inputBlocks(inF,beginDT,endDT))
+    times = np.concatenate([np.empty(0,dtype='datetime64[us]')] +
+                           [b[0] for b in blocks])
+    data = np.concatenate([np.empty(0)] + [b[1] for b in blocks])
+    lines = None
+    if options.inputFormat != 'tidebin':
+        lines = list(itertools.chain(*[b[3] for b in blocks]))
+
+    keep = trim.keepMask(times,data)
+    tideOutputBlock(outF,
+                    timeFormat=options.timeFormat,
+                    times=times[keep],
+                    waterlevels=data[keep],
+                    fieldSep=options.fieldSep,
+                    recSep=options.recSep)
+    if bdf != None:
+        writeBad(bdf,lines,np.flatnonzero(~keep),times[~keep],data[~keep])
+
+    goodCntr = int(keep.sum())
+    return (goodCntr,len(keep) - goodCntr)
+
+
+def inputBlocks(inF,beginDT=None,endDT=None):
+    '''
+    the (times, values, otherFields, lines) blocks of the input for the
+    block and batch modes. lines are the data lines of the block as
+    they were read, for the bad data file; None for tidebin input.
+    '''
+
+    if options.inputFormat == 'tidebin':
+        # only the pages within the time window are read
+        blocks = tideBinBlocks(options.input,beginDT,endDT,
+                               blockSize=options.blockSize)
+        return (block + (None,) for block in blocks)
+
+    blocks = lineBlocks(inF)
+    if options.sortedInput and endDT != None:
+        blocks = blocksUntil(blocks,endDT)
+    return blocks
+
+
+def lineBlocks(inF):
+    '''
+    readTideBlocks that also keeps the data lines of each block
+    '''
+
+    while True:
+        lines = list(itertools.islice(inF,options.blockSize))
+        if len(lines) == 0:
+            break
+        if options.recSep != '\n':
+            lines = [record + options.recSep for record in
+                     ''.join(lines).replace(options.recSep,'\n').splitlines()]
+        lines = [line for line in lines if not skipRE.match(line)]
+        if len(lines) == 0:
+            continue
+        records = lines
+        if options.recSep != '\n':
+            records = [line[:-len(options.recSep)] for line in lines]
+        block = tideLinesToArrays(records,options.inputFormat,
+                                  options.fieldSep)
+        yield block + (lines,)
+
+
+def recordLines(inF):
+    '''
+    the (record, line) pairs of the data lines of a text input for the
+    streaming mode, as readTideRecords parses them
+    '''
+
+    parse = tideParser(options.inputFormat,options.fieldSep)
+    skip = skipRE.match
+    for line in inF:
+        if skip(line):
+            continue # not a data record line
+        yield (parse(line),line)
+
+
+def writeBad(bdf,lines,index,times,values):
+    '''
+    writes the bad records at index of lines to bdf as they were read;
+    tidebin input (lines None) has no lines, so its bad times and
+    values are written out instead
+    '''
+
+    if lines != None:
+        bdf.write(''.join([lines[i] for i in index.tolist()]))
+    else:
+        tideOutputBlock(bdf,
+                        timeFormat=options.timeFormat,
+                        times=times,
+                        waterlevels=values,
+                        fieldSep=options.fieldSep,
+                        recSep=options.recSep)
+
+
+def blocksUntil(blocks,endDT):
+    '''
+    passes on blocks of time sorted records up to and including the
+    first one that reaches past endDT
+    '''
+
+    endT = np.datetime64(endDT,'us')
+    for block in blocks:
+        yield block
+        if len(block[0]) > 0 and block[0][-1] > endT:
+            break
+
+
+def windowLSRtest(times,values,width,sigmas,chunk=lsrRebaseInterval):
+    '''
+    Applies the LSLRstdevEval test to every run of width consecutive
+    samples at once. times are in float seconds. Returns a boolean
+    array with one entry per window (len(values) - width + 1), True
+    where the center value is within sigmas standard deviations of the
+    least squares line through the window.
+
+    The sums of LSLRstdevEval come from cumulative sums, taken over
+    chunk windows at a time relative to the first record of the chunk
+    (as Trim.rebase does), so memory does not grow with the width.
+    '''
+
+    times = np.ascontiguousarray(times,dtype=np.float64)
+    values = np.ascontiguousarray(values,dtype=np.float64)
+    center = width / 2
+    n = float(width)
+    nWindows = max(len(values) - width + 1,0)
+    result = np.empty(nWindows,dtype=bool)
+
+    for start in xrange(0,nWindows,chunk):
+        count = min(chunk,nWindows - start)
+        t = times[start:start+count+width-1] - times[start]
+        y = values[start:start+count+width-1] - values[start]
+        sums = []
+        for column in (t,t * t,y,t * y,y * y):
+            total = np.cumsum(np.concatenate(([0.0],column)))
+            sums.append(total[width:] - total[:count])
+        (sumT,sumTT,sumY,sumTY,sumYY) = sums
+
+        varT = sumTT - sumT * sumT / n # all n times the variance
+        covTY = sumTY - sumT * sumY / n
+        varY = sumYY - sumY * sumY / n
+        m = np.zeros(count)
+        np.divide(covTY,varT,out=m,where=(varT > 0))
+        b = (sumY - m * sumT) / n
+        # the residuals of a least squares line have a mean of 0
+        stdev = np.sqrt(np.maximum(varY - m * covTY,0.0) / n)
+
+        testIntr = m * t[center:center+count] + b
+        diff = np.abs(y[center:center+count] - testIntr)
+        result[start:start+count] = diff < sigmas * stdev
+
+    return result
+
+
+def lsrTest(T,Y,sigmas):
+    '''
+    the test of windowLSRtest for the rows of the (n, width) arrays
+    of times T and values Y
+    '''
+
+    width = T.shape[1]
+    center = width / 2
+    # fit relative to the center time, so the intercept is the
+    # fitted value at the center
+    T = T - T[:,center:center+1]
+    sumT = T.sum(axis=1)
+    sumY = Y.sum(axis=1)
+    m = ((width * (T * Y).sum(axis=1) - sumT * sumY) /
+         (width * (T * T).sum(axis=1) - sumT * sumT))
+    b = (sumY - m * sumT) / width
+    residuals = Y - (m[:,np.newaxis] * T + b[:,np.newaxis])
+    stdev = np.sqrt((residuals * residuals).mean(axis=1))
+    return (np.abs(Y[:,center] - b) < sigmas * stdev)
+
+
+def medianTest(Y,sigmas):
+    '''
+    the test of windowMedianTest for the rows of the (n, width) array Y
+    '''
+    center = Y.shape[1] / 2
+    median = np.median(Y,axis=1)
+    mad = np.median(np.abs(Y - median[:,np.newaxis]),axis=1)
+    return (np.abs(Y[:,center] - median) <= sigmas * madScale * mad)
+
+
+def stdevTest(Y,sigmas):
+    '''
+    the test of windowStdevTest for the rows of the (n, width) array Y
+    '''
+    center = Y.shape[1] / 2
+    return (np.abs(Y[:,center] - Y.mean(axis=1)) < sigmas * Y.std(axis=1))
+
+
+def windowMedianTest(values,width,sigmas):
+    '''
+    the robust version of windowLSRtest: True where the center value
+    of a window is within sigmas scaled median absolute deviations of
+    the median of the window (see RollingMedian.test)
+    '''
+
+    center = width / 2
+    nWindows = max(len(values) - width + 1,0)
+    result = np.empty(nWindows,dtype=bool)
+    values = np.asarray(values,dtype=np.float64).tolist()
+
+    rolling = RollingMedian(width)
+    for value in values[:width - 1]:
+        rolling.add(value)
+    for start in xrange(nWindows):
+        rolling.add(values[start + width - 1])
+        result[start] = rolling.test(values[start + center],sigmas)
+        rolling.remove(values[start])
+
+    return result
+
+
+def windowStdevTest(values,width,sigmas):
+    '''
+    the simple statistics version of windowLSRtest: True where the
+    center value of a window is within sigmas standard deviations of
+    the mean of the window
+    '''
+
+    values = np.ascontiguousarray(values,dtype=np.float64)
+    center = width / 2
+    nWindows = max(len(values) - width + 1,0)
+    if nWindows == 0:
+        return np.empty(0,dtype=bool)
+
+    # sums over the windows from cumulative sums, about the overall
+    # mean so they keep their precision
+    y = values - values.mean()
+    sumY = np.cumsum(np.concatenate(([0.0],y)))
+    sumYY = np.cumsum(np.concatenate(([0.0],y * y)))
+    mean = (sumY[width:] - sumY[:nWindows]) / width
+    var = (sumYY[width:] - sumYY[:nWindows]) / width - mean * mean
+    stdev = np.sqrt(np.maximum(var,0.0))
+
+    return (np.abs(y[center:center+nWindows] - mean) < sigmas * stdev)
+
+
+
+madScale = 1.4826 # median absolute deviations in a standard deviation
 
+class RollingMedian():
+    '''
+    The median and median absolute deviation (MAD) of a sliding window
+    of values, kept sorted in an IndexableSkiplist: adding and removing
+    a value is O(log width), the median O(log width) and the MAD
+    O(log^2 width).
+    '''
+
+    def __init__(self,width):
+        self.values = IndexableSkiplist(width)
+
+    def add(self,value):
+        self.values.insert(value)
+
+    def remove(self,value):
+        self.values.remove(value)
+
+    def median(self):
+        n = len(self.values)
+        if n % 2:
+            return self.values[n / 2]
+        return (self.values[n / 2 - 1] + self.values[n / 2]) / 2.0
+
+    def mad(self):
+        '''
+        the median of the distances of the values from their median:
+        the distances below and above the median are two sorted runs,
+        so it is their merged middle element (the mean of the middle
+        two for an even number of values)
+        '''
+
+        n = len(self.values)
+        c = n / 2
+        median = self.median()
+        values = self.values
+        if n % 2:
+            below = lambda i: median - values[c - i] # c + 1 of them
+            above = lambda j: values[c + 1 + j] - median # c of them
+            return kthOfRuns(below,c + 1,above,c,c)
+        below = lambda i: median - values[c - 1 - i] # c of them
+        above = lambda j: values[c + j] - median # c of them
+        return (kthOfRuns(below,c,above,c,c - 1) +
+                kthOfRuns(below,c,above,c,c)) / 2.0
+
+    def test(self,value,sigmas):
+        '''
+        True if value is within sigmas scaled MADs of the median; a
+        value at the median passes even when the MAD is 0
+        '''
+        return (abs(value - self.median()) <= sigmas * madScale * self.mad())
+
+
+def kthOfRuns(a,na,b,nb,k):
+    '''
+    the k-th smallest (from 0) of two sorted runs, given as functions
+    a and b of the index and their lengths na and nb, in O(log k)
+    calls of them
+    '''
+
+    # take i from a and k + 1 - i from b, the fewest from a that leave
+    # no smaller value out
+    (lo,hi) = (max(0,k + 1 - nb),min(na,k + 1))
+    while lo < hi:
+        i = (lo + hi) / 2
+        if a(i) < b(k - i):
+            lo = i + 1
+        else:
+            hi = i
+    if lo == 0:
+        return b(k)
+    if lo == k + 1:
+        return a(k)
+    return max(a(lo - 1),b(k - lo))
+
+
+class IndexableSkiplist():
+    '''
+    A sorted list with O(log n) insert, remove and indexing by rank
+    (after R. Hettinger's running median recipe). Each node has links
+    to later nodes at several levels and the number of places each
+    link skips. The tail node holds no value and is told apart by
+    identity, so any value that orders (inf too) can be kept; NaN
+    cannot.
+    '''
+
+    def __init__(self,expectedSize=100):
+        self.size = 0
+        self.maxLevels = int(1 + math.log(max(expectedSize,2),2))
+        self.tail = SkiplistNode(None,[],[])
+        self.head = SkiplistNode(None,[self.tail] * self.maxLevels,
+                                 [1] * self.maxLevels)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self,i):
+        node = self.head
+        i += 1
+        for level in reversed(xrange(self.maxLevels)):
+            while node.width[level] <= i:
+                i -= node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def insert(self,value):
+        # the last node before value on each level, and how far along
+        chain = [None] * self.maxLevels
+        steps = [0] * self.maxLevels
+        node = self.head
+        tail = self.tail
+        for level in reversed(xrange(self.maxLevels)):
+            while (node.next[level] is not tail and
+                   node.next[level].value <= value):
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        levels = 1
+        while levels < self.maxLevels and getrandbits(1):
+            levels += 1
+        new = SkiplistNode(value,[None] * levels,[None] * levels)
+        skipped = 0
+        for level in xrange(levels):
+            previous = chain[level]
+            new.next[level] = previous.next[level]
+            previous.next[level] = new
+            new.width[level] = previous.width[level] - skipped
+            previous.width[level] = skipped + 1
+            skipped += steps[level]
+        for level in xrange(levels,self.maxLevels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self,value):
+        # the last node before value on each level
+        chain = [None] * self.maxLevels
+        node = self.head
+        tail = self.tail
+        for level in reversed(xrange(self.maxLevels)):
+            while (node.next[level] is not tail and
+                   node.next[level].value < value):
+                node = node.next[level]
+            chain[level] = node
+        if chain[0].next[0] is tail or chain[0].next[0].value != value:
+            raise KeyError('not in the skiplist: %r' % value)
+
+        levels = len(chain[0].next[0].next)
+        for level in xrange(levels):
+            previous = chain[level]
+            previous.width[level] += previous.next[level].width[level] - 1
+            previous.next[level] = previous.next[level].next[level]
+        for level in xrange(levels,self.maxLevels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+class SkiplistNode(object):
+    __slots__ = ('value','next','width')
+    def __init__(self,value,next,width):
+        (self.value,self.next,self.width) = (value,next,width)
 
 
 class Trim():
@@ -176,7 +700,6 @@ class Trim():
         self.beginT = beginT
         self.endT = endT
         self.sigmas = sigmas
-        self.queue = empty((0,2)) # empty array, two columns
         if width != None:
             if (width % 2) == 0:
                 # can only be an odd number
@@ -185,6 +708,25 @@ class Trim():
                 self.width = width
         self.center = self.width / 2
 
+        # the queue of test: the last width (datetime, value, epoch
+        # seconds) records in a ring, oldest first from self.oldest,
+        # and the sums of their t, t^2, y, ty and y^2 for the least
+        # squares line, with t and y relative to tRef and yRef
+        self.ring = [None] * self.width
+        self.pushed = 0 # records pushed so far
+        self.oldest = 0
+        self.tRef = 0
+        self.yRef = 0.0
+        self.sums = [0.0] * 5
+        self.rolling = None # a RollingMedian of the queue, for --median
+        self.rejected = 0 # records that failed the outlier test
+        self.passes = 0 # of keepMask over the data, for --iterate
+
+        # state carried between blocks by testBlock
+        self.blockCount = 0 # records in range so far
+        self.blockTimes = np.empty(0,dtype='datetime64[us]')
+        self.blockValues = np.empty(0,dtype=np.float64)
+
 
 ############
     def test(self,time,data):
@@ -198,25 +740,259 @@ class Trim():
             return [None,None]
         if ( (self.endT != None) and ( self.endT < time)):
             return [None,None]
+        # NaN and inf values (float() takes them) cannot be tested
+        # against a window, so they are dropped like bad records
+        if math.isnan(data) or math.isinf(data):
+            return [None,None]
 
 
-        # a outlier filter is specified: use it
-        if (options.LSR):
-
-            self.queue = vstack((self.queue,[time,data])) # push
+        # push, dropping the earliest member once the queue is full
+        self.push(time,data)
 
-            # we have a full queue - let's use it
-            if len(self.queue) > self.width:
-                # first, let's drop the earliest member of the queue
-                self.queue = self.queue[1:,:] # equivalent to a shift
-                # now do the stats
-                if (self.LSLRstdevEval()):
-                    return self.queue[self.center]
-                else:
-                    return [None,None]
+        # we have a full queue - let's use it
+        if self.pushed > self.width:
+            # now do the stats
+            if (options.median):
+                passed = self.rolling.test(self.centerRecord()[1],
+                                           self.sigmas)
+            elif (options.LSR):
+                passed = self.LSLRstdevEval()
+            else:
+                passed = self.stdevEval()
+            if passed:
+                return list(self.centerRecord()[:2])
+            else:
+                self.rejected += 1
+                return [None,None]
 
         return ([time,data])
 
+############
+    def push(self,dTime,value):
+        '''
+        adds a record to the queue of test, in place of the oldest one
+        once there are width of them, and updates the running sums
+        '''
+
+        seconds = calendar.timegm(dTime.timetuple()) # as mktime, in UTC
+        if self.pushed == 0:
+            (self.tRef,self.yRef) = (seconds,value)
+        if options.median:
+            if self.rolling == None:
+                self.rolling = RollingMedian(self.width)
+            if self.pushed >= self.width:
+                self.rolling.remove(self.ring[self.oldest][1])
+            self.rolling.add(value)
+        if self.pushed >= self.width:
+            self.addSums(self.ring[self.oldest],-1)
+            self.ring[self.oldest] = (dTime,value,seconds)
+            self.addSums(self.ring[self.oldest],1)
+            self.oldest = (self.oldest + 1) % self.width
+        else:
+            self.ring[self.pushed] = (dTime,value,seconds)
+            self.addSums(self.ring[self.pushed],1)
+        self.pushed += 1
+
+        if self.pushed % lsrRebaseInterval == 0:
+            self.rebase()
+
+    def addSums(self,record,sign):
+        '''
+        adds (sign 1) or takes away (sign -1) a record from the sums
+        '''
+        t = float(record[2] - self.tRef)
+        y = record[1] - self.yRef
+        sums = self.sums
+        sums[0] += sign * t
+        sums[1] += sign * t * t
+        sums[2] += sign * y
+        sums[3] += sign * t * y
+        sums[4] += sign * y * y
+
+    def rebase(self):
+        '''
+        recomputes the sums from the queue, relative to its oldest
+        record, so the rounding of the running updates does not build up
+        '''
+        records = [r for r in self.ring if r != None]
+        (self.tRef,self.yRef) = (self.ring[self.oldest][2],
+                                 self.ring[self.oldest][1])
+        self.sums = [0.0] * 5
+        for record in records:
+            self.addSums(record,1)
+
+    def centerRecord(self):
+        '''
+        the (datetime, value, seconds) record at the center of the queue
+        '''
+        return self.ring[(self.oldest + self.center) % self.width]
+
+############
+    def testRecords(self,records):
+        '''
+        generator version of test: yields the (datetime, value) of the
+        (datetime, value, ..) records that pass
+        '''
+
+        for record in records:
+            (oTime,oData) = self.test(record[0],record[1])
+            if(oTime != None) and (oData != None):
+                yield (oTime,oData)
+
+############
+    def testBlock(self,times,values):
+        '''
+        block version of test. times (datetime64) and values are arrays
+        of consecutive records. Returns (goodTimes, goodValues, badTimes,
+        badValues, badIndex): the records test would have returned for
+        each record, in the same order, the records that were rejected
+        and the positions in the block of the records test returned
+        nothing for (those whose lines go to the bad data file).
+        '''
+
+        times = np.asarray(times).astype('datetime64[us]')
+        values = np.asarray(values,dtype=np.float64)
+
+        # the time constraints, and finite values (see test)
+        inRange = np.isfinite(values)
+        if self.beginT != None:
+            inRange &= (times >= np.datetime64(self.beginT,'us'))
+        if self.endT != None:
+            inRange &= (times <= np.datetime64(self.endT,'us'))
+        inIdx = np.flatnonzero(inRange)
+        outIdx = np.flatnonzero(~inRange)
+        inTimes = times[inIdx]
+        inValues = values[inIdx]
+
+        # the first width records in range are passed as they come,
+        # after that each record releases the center of the window it
+        # completes (see test)
+        nPass = max(min(self.width - self.blockCount,len(inIdx)),0)
+        qTimes = np.concatenate((self.blockTimes,inTimes))
+        qValues = np.concatenate((self.blockValues,inValues))
+        first = len(self.blockTimes) + nPass - self.width + 1
+        if nPass < len(inIdx):
+            ok = self.windowTest(qTimes[first:],qValues[first:])
+        else:
+            ok = np.empty(0,dtype=bool)
+        self.rejected += int((~ok).sum())
+        centers = np.arange(len(ok)) + first + self.center
+        arrivals = inIdx[nPass:]
+
+        goodTimes = np.concatenate((inTimes[:nPass],qTimes[centers[ok]]))
+        goodValues = np.concatenate((inValues[:nPass],qValues[centers[ok]]))
+        # rejected records, in the order they were found
+        badIdx = np.concatenate((outIdx,arrivals[~ok]))
+        badOrder = np.argsort(badIdx,kind='mergesort')
+        badTimes = np.concatenate((times[outIdx],qTimes[centers[~ok]]))
+        badValues = np.concatenate((values[outIdx],qValues[centers[~ok]]))
+
+        self.blockCount += len(inIdx)
+        keep = min(self.width - 1,len(qTimes))
+        self.blockTimes = qTimes[len(qTimes)-keep:]
+        self.blockValues = qValues[len(qValues)-keep:]
+
+        return (goodTimes,goodValues,badTimes[badOrder],badValues[badOrder],
+                badIdx[badOrder])
+
+############
+    def keepMask(self,times,values):
+        '''
+        batch version of test. times (datetime64) and values are arrays
+        of all of the records. Returns a boolean array, True for the
+        records to keep. Unlike test, each record is tested once,
+        against the window of width records centered on it; the records
+        at the ends, without a full window, are only held to the time
+        constraints. With --iterate the test is repeated on the records
+        that are left until it removes nothing more (see retest).
+        '''
+
+        times = np.asarray(times).astype('datetime64[us]')
+        values = np.asarray(values,dtype=np.float64)
+
+        # the time constraints, and finite values (see test)
+        keep = np.isfinite(values)
+        if self.beginT != None:
+            keep &= (times >= np.datetime64(self.beginT,'us'))
+        if self.endT != None:
+            keep &= (times <= np.datetime64(self.endT,'us'))
+        inIdx = np.flatnonzero(keep)
+        if len(inIdx) < self.width:
+            return keep
+
+        ok = self.windowTest(times[inIdx],values[inIdx])
+        keep[inIdx[self.center:self.center+len(ok)]] = ok
+        self.rejected += int((~ok).sum())
+        self.passes = 1
+
+        if options.iterate:
+            epoch = (times - times[inIdx[0]]).astype(np.int64) / 1e6
+            removed = np.zeros(len(inIdx),dtype=bool)
+            removed[self.center:self.center+len(ok)] = ~ok
+            self.retest(epoch,values,keep,inIdx,removed)
+
+        return keep
+
+    def retest(self,epoch,values,keep,inIdx,removed):
+        '''
+        the later passes of --iterate. inIdx are the records of the last
+        pass, and removed marks the ones it took out. A window that
+        has lost none of its records would give the same answer as
+        before, so each pass tests only the records whose window now
+        reaches across a removed one. keep is updated in place.
+        '''
+
+        c = self.center
+        while removed.any():
+            self.passes += 1
+            kept = ~removed
+            # where the records after each removed one are now
+            after = np.cumsum(kept)[removed]
+            inIdx = inIdx[kept]
+            n = len(inIdx)
+            # the windows of c .. n-1-c that reach across a gap
+            marks = np.zeros(n + 1,dtype=np.int64)
+            np.add.at(marks,np.clip(after - c,0,n),1)
+            np.add.at(marks,np.clip(after + c,0,n),-1)
+            dirty = np.flatnonzero(np.cumsum(marks[:n]) > 0)
+            dirty = dirty[(dirty >= c) & (dirty < n - c)]
+
+            removed = np.zeros(n,dtype=bool)
+            (passEpoch,passValues) = (epoch[inIdx],values[inIdx])
+            # the gathered windows are held at once, so fewer of the
+            # wider ones
+            step = max(1,windowChunkValues / self.width)
+            for start in xrange(0,len(dirty),step):
+                centers = dirty[start:start+step]
+                ok = self.testWindows(passEpoch,passValues,centers)
+                removed[centers[~ok]] = True
+            keep[inIdx[removed]] = False
+            self.rejected += int(removed.sum())
+
+    def testWindows(self,epoch,values,centers):
+        '''
+        the outlier test of the options for the windows centered on the
+        records at centers, of epoch (float seconds) and values
+        '''
+        index = centers[:,np.newaxis] + np.arange(-self.center,self.center+1)
+        if options.median:
+            return medianTest(values[index],self.sigmas)
+        if options.LSR:
+            return lsrTest(epoch[index],values[index],self.sigmas)
+        return stdevTest(values[index],self.sigmas)
+
+    def windowTest(self,times,values):
+        '''
+        the outlier test of the options for every run of width records
+        of the datetime64 times and values (see windowLSRtest)
+        '''
+        if options.median:
+            return windowMedianTest(values,self.width,self.sigmas)
+        if options.LSR:
+            epoch = (times - times[0]).astype(np.int64) / 1e6
+            return windowLSRtest(epoch,values,self.width,self.sigmas)
+        return windowStdevTest(values,self.width,self.sigmas)
+
 #############
     def stdevEval(self):
         '''
@@ -226,17 +1002,12 @@ class Trim():
         else returns True
         '''
 
-        times = []
-        for td in self.queue[:,0]:
-            # using epoch seconds
-            times.append(time.mktime(td.timetuple()))
-
-        times = self.queue[:,0]
-        vals = self.queue[:,1] # second column
-        mean = vals.mean()
-        stdev = vals.std()
-        diff = abs(mean,vals[center])
-        if (diff < (sigmas * stdev)):
+        n = float(self.width)
+        sumY = self.sums[2]
+        mean = sumY / n
+        stdev = math.sqrt(max(self.sums[4] / n - mean * mean,0.0))
+        diff = abs((self.centerRecord()[1] - self.yRef) - mean)
+        if (diff < (self.sigmas * stdev)):
             return True
         else:
             return False
@@ -245,23 +1016,25 @@ class Trim():
         '''
         applies the stdevEval to least squares
         linear regression for the points in the
-        queue
+        queue. The line and the standard deviation of the residuals
+        come from the running sums, so no pass over the queue is needed.
         '''
 
-        times = []
-        for td in self.queue[:,0]:
-            # using epoch seconds
-            times.append(time.mktime(td.timetuple()))
-        times = array(times)
-        vals = self.queue[:,1]
-        (m,b) = polyfit(times,vals,1)
-        mt = times * m
-        intercepts = mt + b
-        diffs = vals - intercepts
-        stdev = std(diffs)
-        testVal = float(self.queue[self.center,1])
-        testIntr = float(intercepts[self.center])
-        diff = abs(testVal - testIntr)
+        n = float(self.width)
+        (sumT,sumTT,sumY,sumTY,sumYY) = self.sums
+        varT = sumTT - sumT * sumT / n # all n times the variance
+        covTY = sumTY - sumT * sumY / n
+        varY = sumYY - sumY * sumY / n
+        m = 0.0
+        if varT > 0:
+            m = covTY / varT
+        b = (sumY - m * sumT) / n
+        # the residuals of a least squares line have a mean of 0
+        stdev = math.sqrt(max(varY - m * covTY,0.0) / n)
+
+        (testTime,testVal,testSeconds) = self.centerRecord()
+        testIntr = m * (testSeconds - self.tRef) + b
+        diff = abs((testVal - self.yRef) - testIntr)
         if (diff < (self.sigmas * stdev)):
             return True
         else: